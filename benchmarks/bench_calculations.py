@@ -0,0 +1,169 @@
+"""
+Micro-benchmarks of the tariff calculations and result rendering
+
+    python benchmarks/bench_calculations.py                      # print ns/op
+    python benchmarks/bench_calculations.py --save baseline.json
+    python benchmarks/bench_calculations.py --baseline baseline.json --threshold 0.15
+
+Inputs are fixed and the clock is frozen, so results only depend on the code and
+the machine. With --baseline the exit code is 1 if any benchmark got slower than
+the threshold (relative), so it can gate a deploy.
+"""
+import argparse
+import json
+import os
+import platform
+import sqlite3
+import sys
+import timeit
+from datetime import datetime
+from typing import Callable, Dict
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# The bot module creates a Bot at import time; no request is ever made here
+os.environ.setdefault('BOT_TOKEN', '123456:benchmark')
+
+import customs_calculator_bot as bot_module  # noqa: E402
+
+FROZEN_NOW = datetime(2025, 6, 1, 12, 0, 0)
+USD_RATE = 41.5
+EUR_RATE = 47.25
+
+
+class FrozenDatetime(datetime):
+    """datetime whose now() is fixed (age coefficients depend on the current year)"""
+
+    @classmethod
+    def now(cls, tz=None):
+        return FROZEN_NOW
+
+
+bot_module.datetime = FrozenDatetime
+
+VEHICLES = {
+    'car_petrol': {'cost': 15000, 'currency': 'USD', 'engine_volume': 2000, 'year': 2017},
+    'car_diesel': {'cost': 14000, 'currency': 'EUR', 'engine_volume': 2500, 'year': 2015},
+    'car_electric_no_benefits': {'cost': 20000, 'currency': 'USD', 'battery_kwh': 75},
+    'car_hybrid_petrol': {'cost': 18000, 'currency': 'USD', 'engine_volume': 1800, 'year': 2019},
+    'truck_diesel': {'cost': 30000, 'currency': 'EUR', 'engine_volume': 7000, 'year': 2012},
+    'moto_petrol': {'cost': 5000, 'currency': 'USD', 'engine_volume': 650},
+}
+for _vehicle_type, _data in VEHICLES.items():
+    _data.update(vehicle_type=_vehicle_type, additional=500, additional_currency='USD')
+
+
+def history_rows(as_sqlite: bool):
+    """Five history entries as dicts (memory fallback) or sqlite3.Row (database)"""
+    rows = []
+    for i, data in enumerate(list(VEHICLES.values())[:5]):
+        calc = bot_module.compute_customs(data, USD_RATE, EUR_RATE)
+        rows.append({
+            'vehicle_type': data['vehicle_type'], 'total_payments': calc['total_payments'],
+            'created_at': f'2025-05-{i + 1:02d} 10:00:00', 'year': data.get('year'),
+            'engine_volume': data.get('engine_volume'), 'battery_kwh': data.get('battery_kwh'),
+            'total_uah': calc['total_uah'], 'total_customs': calc['total_customs'],
+            'currency': data['currency'], 'usd_rate': USD_RATE, 'eur_rate': EUR_RATE,
+            'date': f'0{i + 1}.05.2025 10:00',
+        })
+    if not as_sqlite:
+        return rows
+
+    conn = sqlite3.connect(':memory:')
+    conn.row_factory = sqlite3.Row
+    columns = list(rows[0])
+    conn.execute(f"CREATE TABLE calculations ({', '.join(columns)})")
+    conn.executemany(f"INSERT INTO calculations VALUES ({', '.join('?' * len(columns))})",
+                     [tuple(row[c] for c in columns) for row in rows])
+    return conn.execute('SELECT * FROM calculations').fetchall()
+
+
+def benchmarks() -> Dict[str, Callable[[], object]]:
+    b = bot_module
+    cost = 15000 * USD_RATE
+    cases = {
+        'calculate_age_coefficient': lambda: b.calculate_age_coefficient(2017),
+        'calculate_petrol_car': lambda: b.calculate_petrol_car(cost, 2000, 2017),
+        'calculate_diesel_car': lambda: b.calculate_diesel_car(cost, 2500, 2015),
+        'calculate_electric_car': lambda: b.calculate_electric_car(cost, 75, False),
+        'calculate_hybrid_petrol': lambda: b.calculate_hybrid_petrol(cost, 1800, 2019),
+        'calculate_hybrid_diesel': lambda: b.calculate_hybrid_diesel(cost, 2000, 2019),
+        'calculate_truck': lambda: b.calculate_truck(cost, 5000, 2012),
+        'calculate_diesel_truck': lambda: b.calculate_diesel_truck(cost, 7000, 2012),
+        'calculate_electric_truck': lambda: b.calculate_electric_truck(cost),
+        'calculate_motorcycle': lambda: b.calculate_motorcycle(cost, 650),
+        'calculate_electric_motorcycle': lambda: b.calculate_electric_motorcycle(cost),
+        'calculate_pension_fund': lambda: b.calculate_pension_fund(cost),
+    }
+
+    # Full tariff path and HTML rendering of perform_calculation
+    for vehicle_type, data in VEHICLES.items():
+        cases[f'compute_customs[{vehicle_type}]'] = (
+            lambda data=data: b.compute_customs(data, USD_RATE, EUR_RATE))
+    data = VEHICLES['car_petrol']
+    calc = b.compute_customs(data, USD_RATE, EUR_RATE)
+    cases['format_calculation'] = lambda: b.format_calculation(data, calc, FROZEN_NOW, USD_RATE, EUR_RATE)
+
+    # show_history rendering for both row sources
+    memory_rows, db_rows = history_rows(False), history_rows(True)
+    cases['format_history[memory]'] = lambda: b.format_history(memory_rows)
+    cases['format_history[sqlite]'] = lambda: b.format_history(db_rows)
+    return cases
+
+
+def measure(func: Callable[[], object], repeat: int) -> float:
+    """Best-of-`repeat` time per call, ns (each run lasts at least ~0.2 s)"""
+    timer = timeit.Timer(func)
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat, number)) / number * 1e9
+
+
+def compare(results: Dict[str, float], baseline: Dict[str, float], threshold: float) -> bool:
+    """Printing changes against the baseline; False if anything regressed"""
+    ok = True
+    for name, ns in results.items():
+        old = baseline.get(name)
+        if old is None:
+            print(f"{name:<44}{ns:>12.1f} ns/op   (new)")
+            continue
+        change = ns / old - 1
+        regressed = change > threshold
+        ok &= not regressed
+        print(f"{name:<44}{ns:>12.1f} ns/op {change:>+8.1%}{'  REGRESSION' if regressed else ''}")
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--filter', default='', help='run only benchmarks whose name contains this')
+    parser.add_argument('--save', help='write results as JSON')
+    parser.add_argument('--baseline', help='JSON results to compare against')
+    parser.add_argument('--threshold', type=float, default=0.10, help='allowed slowdown, relative')
+    args = parser.parse_args()
+
+    results = {}
+    for name, func in benchmarks().items():
+        if args.filter in name:
+            results[name] = round(measure(func, args.repeat), 1)
+            if not args.baseline:
+                print(f"{name:<44}{results[name]:>12.1f} ns/op")
+
+    ok = True
+    if args.baseline:
+        with open(args.baseline) as f:
+            ok = compare(results, json.load(f)['results'], args.threshold)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({
+                'python': platform.python_version(),
+                'machine': platform.machine(),
+                'frozen_now': FROZEN_NOW.isoformat(),
+                'results': results,
+            }, f, indent=2)
+
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
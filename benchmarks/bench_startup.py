@@ -0,0 +1,147 @@
+"""
+Cold start benchmark: import time and time to the first answered update
+
+    python benchmarks/bench_startup.py --boots 5
+
+Scale-to-zero instances pay the whole startup on the request that woke them up.
+This measures, in fresh processes:
+
+  * import: `import main` (python -X importtime -c "import main" shows the breakdown)
+  * first 200: from spawning `uvicorn main:app` to /webhook accepting a /start update
+  * first reply: until the bot's answer reaches the Bot API
+
+against the same local bank.gov.ua and api.telegram.org stand-ins as
+bench_webhook.py. The stand-ins live across boots, so the first boot registers
+the webhook and later ones should find it up to date (setWebhook per boot).
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from aiohttp import ClientConnectionError, ClientSession
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from bench_webhook import BOT_TOKEN, ROOT, FakeNBU, FakeTelegram, free_port, start_app  # noqa: E402
+
+START_UPDATE_USER = 20_000_000
+
+
+def child_env(tg_port: int, nbu_port: int, app_port: int) -> dict:
+    env = dict(os.environ)
+    env.update({
+        'PYTHONPATH': ROOT,
+        'BOT_TOKEN': BOT_TOKEN,
+        'TELEGRAM_API_URL': f'http://127.0.0.1:{tg_port}',
+        'NBU_API_URL': f'http://127.0.0.1:{nbu_port}',
+        'KOYEB_APP_URL': f'127.0.0.1:{app_port}',
+        'WEBHOOK_SECRET': '',
+    })
+    return env
+
+
+def measure_import(env: dict, runs: int) -> float:
+    """Median seconds of `import main` in a fresh interpreter"""
+    code = "import time; t = time.perf_counter(); import main; print(time.perf_counter() - t)"
+    times = []
+    for _ in range(runs):
+        output = subprocess.run([sys.executable, '-c', code], env=env, capture_output=True, text=True, check=True)
+        times.append(float(output.stdout.strip().splitlines()[-1]))
+    return statistics.median(times)
+
+
+def start_update(update_id: int) -> dict:
+    user = {'id': START_UPDATE_USER, 'is_bot': False, 'first_name': 'Bench'}
+    return {'update_id': update_id, 'message': {
+        'message_id': update_id, 'date': int(time.time()), 'from': user, 'text': '/start',
+        'chat': {'id': START_UPDATE_USER, 'type': 'private'},
+        'entities': [{'type': 'bot_command', 'offset': 0, 'length': 6}],
+    }}
+
+
+async def boot(env: dict, app_port: int, telegram: FakeTelegram, update_id: int, timeout: float) -> dict:
+    """One cold start: spawn the app, poll /webhook until it accepts, wait for the reply"""
+    url = f'http://127.0.0.1:{app_port}/webhook'
+    set_webhook_before = telegram.calls['setWebhook']
+    reply = telegram.expect(START_UPDATE_USER, lambda text: True)
+
+    started = time.perf_counter()
+    process = await asyncio.create_subprocess_exec(
+        sys.executable, '-m', 'uvicorn', 'main:app', '--host', '127.0.0.1', '--port', str(app_port),
+        '--log-level', 'warning', env=env)
+    try:
+        first_ok = None
+        async with ClientSession() as session:
+            while time.perf_counter() - started < timeout:
+                try:
+                    async with session.post(url, data=json.dumps(start_update(update_id)),
+                                            headers={'Content-Type': 'application/json'}) as response:
+                        if response.status == 200:
+                            first_ok = time.perf_counter() - started
+                            break
+                except ClientConnectionError:
+                    pass
+                await asyncio.sleep(0.01)
+        if first_ok is None:
+            raise RuntimeError(f"/webhook did not answer within {timeout} s")
+        await asyncio.wait_for(reply, timeout)
+        first_reply = time.perf_counter() - started
+        # Startup work that continues in the background (webhook check, rate warm-up)
+        await asyncio.sleep(1)
+    finally:
+        telegram.waiters.pop(START_UPDATE_USER, None)
+        process.terminate()
+        await process.wait()
+
+    return {
+        'first_ok': first_ok,
+        'first_reply': first_reply,
+        'set_webhook': telegram.calls['setWebhook'] - set_webhook_before,
+    }
+
+
+async def run(args):
+    nbu, telegram = FakeNBU(0, 0), FakeTelegram(0, 0)
+    nbu_port, tg_port, app_port = free_port(), free_port(), free_port()
+    runners = [await start_app(nbu.app(), nbu_port), await start_app(telegram.app(), tg_port)]
+    env = child_env(tg_port, nbu_port, app_port)
+    try:
+        import_time = await asyncio.get_running_loop().run_in_executor(None, measure_import, env, args.imports)
+        print(f"import main: median {import_time * 1000:.0f} ms over {args.imports} runs")
+
+        boots = []
+        for i in range(args.boots):
+            result = await boot(env, app_port, telegram, i + 1, args.timeout)
+            boots.append(result)
+            print(f"boot {i + 1}: first 200 {result['first_ok'] * 1000:>6.0f} ms  "
+                  f"first reply {result['first_reply'] * 1000:>6.0f} ms  setWebhook {result['set_webhook']}")
+    finally:
+        for runner in runners:
+            await runner.cleanup()
+
+    print(f"median: first 200 {statistics.median(b['first_ok'] for b in boots) * 1000:.0f} ms, "
+          f"first reply {statistics.median(b['first_reply'] for b in boots) * 1000:.0f} ms")
+    print(f"Bot API calls: {dict(telegram.calls)}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--boots', type=int, default=5)
+    parser.add_argument('--imports', type=int, default=5, help='fresh interpreters for the import timing')
+    parser.add_argument('--timeout', type=float, default=60)
+    args = parser.parse_args()
+
+    # The bot's SQLite files and chart cache go to a scratch directory shared by all boots
+    with tempfile.TemporaryDirectory(prefix='bench-startup-') as workdir:
+        os.chdir(workdir)
+        asyncio.run(run(args))
+
+
+if __name__ == '__main__':
+    main()
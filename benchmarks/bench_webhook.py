@@ -0,0 +1,357 @@
+"""
+End-to-end webhook throughput benchmark, fully offline
+
+    python benchmarks/bench_webhook.py --concurrency 1,10,50 --duration 20
+    python benchmarks/bench_webhook.py --nbu-latency 0.3 --nbu-error-rate 0.05 --tg-latency 0.05
+
+Starts local stand-ins for bank.gov.ua and api.telegram.org (aiohttp, with
+configurable latency and error injection), runs main.py's FastAPI app in-process
+under uvicorn and drives complete calculation dialogs through /webhook:
+
+    /start -> 🚗 -> car_petrol -> 15000 -> USD -> 0 -> 2000 -> 2017 -> date_today
+
+Every virtual user waits for the bot's reply before its next step, like a person.
+For each concurrency level it reports finished quotes per second, step and quote
+latency (p50/p99, from the webhook POST to the bot's Bot API call) and outbound
+call counts. Throttling and per-chat send pacing are lifted so that the instance,
+not Telegram's limits, is measured; set THROTTLE_*/SEND_* in the environment to
+benchmark with them.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import os
+import random
+import socket
+import sys
+import tempfile
+import time
+from collections import Counter
+from datetime import datetime, timedelta
+from typing import Callable, Dict, List, Optional
+
+from aiohttp import ClientSession, web
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+BOT_TOKEN = '123456:benchmark'
+BOT_USER = {'id': 123456, 'is_bot': True, 'first_name': 'Bench bot', 'username': 'bench_bot'}
+RATES = {'USD': 41.5, 'EUR': 47.25}
+RESULT_MARKER = 'Результат розрахунку'
+
+DIALOG = [
+    ('text', '/start'),
+    ('text', '🚗 Легковий автомобіль'),
+    ('callback', 'car_petrol'),
+    ('text', '15000'),
+    ('callback', 'currency_USD'),
+    ('text', '0'),
+    ('text', '2000'),
+    ('text', '2017'),
+    ('callback', 'date_today'),
+]
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def new_stats() -> dict:
+    return {'quotes': 0, 'failed': 0, 'timeouts': 0, 'step_latency': [], 'quote_latency': [],
+            'dialog_time': [], 'webhook_status': Counter()}
+
+
+class FakeNBU:
+    """bank.gov.ua stand-in: single-day and range rate endpoints"""
+
+    def __init__(self, latency: float, error_rate: float):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.calls = Counter()
+
+    async def _delay_or_fail(self, endpoint: str) -> Optional[web.Response]:
+        self.calls[endpoint] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if random.random() < self.error_rate:
+            self.calls[f'{endpoint}:error'] += 1
+            return web.Response(status=500, text='Internal Server Error')
+        return None
+
+    async def exchange(self, request: web.Request) -> web.Response:
+        error = await self._delay_or_fail('exchange')
+        if error is not None:
+            return error
+        currency = request.query['valcode'].upper()
+        date = datetime.strptime(request.query['date'], '%Y%m%d').strftime('%d.%m.%Y')
+        return web.json_response([{'cc': currency, 'rate': RATES[currency], 'exchangedate': date}])
+
+    async def exchange_site(self, request: web.Request) -> web.Response:
+        error = await self._delay_or_fail('exchange_site')
+        if error is not None:
+            return error
+        currency = request.query['valcode'].upper()
+        start = datetime.strptime(request.query['start'], '%Y%m%d')
+        end = datetime.strptime(request.query['end'], '%Y%m%d')
+        return web.json_response([
+            {'exchangedate': (start + timedelta(days=i)).strftime('%d.%m.%Y'), 'rate_per_unit': RATES[currency]}
+            for i in range((end - start).days + 1)
+        ])
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_get('/NBUStatService/v1/statdirectory/exchange', self.exchange)
+        app.router.add_get('/NBU_Exchange/exchange_site', self.exchange_site)
+        return app
+
+
+class FakeTelegram:
+    """api.telegram.org stand-in: records calls and wakes up users waiting for a reply"""
+
+    def __init__(self, latency: float, error_rate: float):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.calls = Counter()
+        self._message_ids = itertools.count(1)
+        # chat_id -> (predicate on the reply text, future)
+        self.waiters: Dict[int, tuple] = {}
+        # Last setWebhook call, returned by getWebhookInfo
+        self.webhook = {'url': '', 'allowed_updates': None}
+
+    def expect(self, chat_id: int, predicate: Callable[[str], bool]) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        self.waiters[chat_id] = (predicate, future)
+        return future
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info['method']
+        self.calls[method] += 1
+        params = dict(await request.post())
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if random.random() < self.error_rate:
+            self.calls[f'{method}:error'] += 1
+            return web.json_response({'ok': False, 'error_code': 500, 'description': 'Internal Server Error'},
+                                     status=500)
+
+        result = True
+        if 'chat_id' in params and 'text' in params:
+            chat_id = int(params['chat_id'])
+            result = {
+                'message_id': int(params.get('message_id') or next(self._message_ids)),
+                'date': int(time.time()),
+                'chat': {'id': chat_id, 'type': 'private'},
+                'from': BOT_USER,
+                'text': params['text'],
+            }
+            waiter = self.waiters.get(chat_id)
+            if waiter is not None and waiter[0](params['text']) and not waiter[1].done():
+                del self.waiters[chat_id]
+                waiter[1].set_result(params['text'])
+        elif method == 'getMe':
+            result = BOT_USER
+        elif method == 'setWebhook':
+            allowed = params.get('allowed_updates')
+            self.webhook = {'url': params.get('url', ''), 'allowed_updates': json.loads(allowed) if allowed else None}
+        elif method == 'getWebhookInfo':
+            result = {'has_custom_certificate': False, 'pending_update_count': 0, **self.webhook}
+            if result['allowed_updates'] is None:
+                del result['allowed_updates']
+        return web.json_response({'ok': True, 'result': result})
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post('/bot{token}/{method}', self.handle)
+        return app
+
+
+async def start_app(app: web.Application, port: int) -> web.AppRunner:
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, '127.0.0.1', port).start()
+    return runner
+
+
+class Driver:
+    """Virtual users posting updates to /webhook"""
+
+    def __init__(self, url: str, telegram: FakeTelegram, step_timeout: float):
+        self.url = url
+        self.telegram = telegram
+        self.step_timeout = step_timeout
+        self._update_ids = itertools.count(1)
+        self._user_ids = itertools.count(10_000_000)
+        self.session: Optional[ClientSession] = None
+
+    def build_update(self, user_id: int, kind: str, value: str) -> dict:
+        user = {'id': user_id, 'is_bot': False, 'first_name': 'Bench'}
+        chat = {'id': user_id, 'type': 'private'}
+        update_id = next(self._update_ids)
+        if kind == 'text':
+            return {'update_id': update_id, 'message': {
+                'message_id': update_id, 'date': int(time.time()), 'chat': chat, 'from': user, 'text': value,
+                **({'entities': [{'type': 'bot_command', 'offset': 0, 'length': len(value)}]}
+                   if value.startswith('/') else {}),
+            }}
+        return {'update_id': update_id, 'callback_query': {
+            'id': str(update_id), 'from': user, 'chat_instance': str(user_id), 'data': value,
+            'message': {'message_id': update_id, 'date': int(time.time()), 'chat': chat, 'from': BOT_USER,
+                        'text': '…'},
+        }}
+
+    async def dialog(self, stats: dict):
+        """One complete calculation; returns when the result arrives or a step times out"""
+        user_id = next(self._user_ids)
+        started = time.perf_counter()
+        for step, (kind, value) in enumerate(DIALOG):
+            last = step == len(DIALOG) - 1
+            predicate = (lambda text: RESULT_MARKER in text or text.startswith('❌')) if last else (lambda text: True)
+            reply = self.telegram.expect(user_id, predicate)
+
+            step_started = time.perf_counter()
+            async with self.session.post(self.url, data=json.dumps(self.build_update(user_id, kind, value)),
+                                         headers={'Content-Type': 'application/json'}) as response:
+                stats['webhook_status'][response.status] += 1
+                if response.status != 200:
+                    stats['failed'] += 1
+                    return
+            try:
+                text = await asyncio.wait_for(reply, self.step_timeout)
+            except asyncio.TimeoutError:
+                self.telegram.waiters.pop(user_id, None)
+                stats['timeouts'] += 1
+                return
+            stats['step_latency'].append(time.perf_counter() - step_started)
+
+            if last:
+                if RESULT_MARKER not in text:
+                    stats['failed'] += 1
+                    return
+                stats['quotes'] += 1
+                stats['quote_latency'].append(time.perf_counter() - step_started)
+                stats['dialog_time'].append(time.perf_counter() - started)
+
+    async def run_level(self, concurrency: int, duration: float) -> dict:
+        stats = new_stats()
+        deadline = time.perf_counter() + duration
+
+        async def user_loop():
+            while time.perf_counter() < deadline:
+                await self.dialog(stats)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(user_loop() for _ in range(concurrency)))
+        stats['elapsed'] = time.perf_counter() - started
+        return stats
+
+
+def report(concurrency: int, stats: dict, nbu_calls: Counter, tg_calls: Counter) -> dict:
+    ms = lambda seconds: round(seconds * 1000, 1)  # noqa: E731
+    row = {
+        'concurrency': concurrency,
+        'quotes': stats['quotes'],
+        'quotes_per_second': round(stats['quotes'] / stats['elapsed'], 2),
+        'failed': stats['failed'],
+        'timeouts': stats['timeouts'],
+        'step_p50_ms': ms(percentile(stats['step_latency'], 0.5)),
+        'step_p99_ms': ms(percentile(stats['step_latency'], 0.99)),
+        'quote_p50_ms': ms(percentile(stats['quote_latency'], 0.5)),
+        'quote_p99_ms': ms(percentile(stats['quote_latency'], 0.99)),
+        'webhook_status': dict(stats['webhook_status']),
+        'nbu_calls': dict(nbu_calls),
+        'telegram_calls': dict(tg_calls),
+    }
+    print(f"{concurrency:>5} users  {row['quotes_per_second']:>8.2f} quotes/s  "
+          f"step p50 {row['step_p50_ms']:>7.1f} ms  p99 {row['step_p99_ms']:>7.1f} ms  "
+          f"quote p50 {row['quote_p50_ms']:>7.1f} ms  p99 {row['quote_p99_ms']:>7.1f} ms  "
+          f"failed {row['failed']}  timeouts {row['timeouts']}")
+    print(f"      NBU {dict(nbu_calls)}  Bot API {dict(tg_calls)}")
+    return row
+
+
+async def run(args):
+    nbu = FakeNBU(args.nbu_latency, args.nbu_error_rate)
+    telegram = FakeTelegram(args.tg_latency, args.tg_error_rate)
+    nbu_port, tg_port, app_port = free_port(), free_port(), free_port()
+    runners = [await start_app(nbu.app(), nbu_port), await start_app(telegram.app(), tg_port)]
+
+    os.environ.update({
+        'BOT_TOKEN': BOT_TOKEN,
+        'TELEGRAM_API_URL': f'http://127.0.0.1:{tg_port}',
+        'NBU_API_URL': f'http://127.0.0.1:{nbu_port}',
+        'KOYEB_APP_URL': f'127.0.0.1:{app_port}',
+        'WEBHOOK_SECRET': '',
+    })
+    for name, value in (('THROTTLE_RATE', '1000000'), ('THROTTLE_BURST', '1000000'),
+                        ('THROTTLE_GLOBAL_RATE', '1000000'), ('THROTTLE_GLOBAL_BURST', '1000000'),
+                        ('SEND_GLOBAL_RATE', '1000000'), ('SEND_CHAT_RATE', '1000000')):
+        os.environ.setdefault(name, value)
+
+    # The bot reads its configuration at import time
+    import uvicorn
+    import main
+    # Per-update INFO lines would bury the report (and cost time); --log-level INFO restores them
+    logging.getLogger().setLevel(args.log_level)
+
+    server = uvicorn.Server(uvicorn.Config(main.app, host='127.0.0.1', port=app_port, log_level='warning'))
+    server_task = asyncio.create_task(server.serve())
+    while not server.started:
+        await asyncio.sleep(0.05)
+
+    driver = Driver(f'http://127.0.0.1:{app_port}/webhook', telegram, args.step_timeout)
+    results = []
+    async with ClientSession() as session:
+        driver.session = session
+        # One dialog to warm up imports, connection pools and the rate cache
+        await driver.dialog(new_stats())
+
+        for concurrency in args.concurrency:
+            nbu.calls.clear()
+            telegram.calls.clear()
+            stats = await driver.run_level(concurrency, args.duration)
+            results.append(report(concurrency, stats, nbu.calls.copy(), telegram.calls.copy()))
+
+    server.should_exit = True
+    await server_task
+    for runner in runners:
+        await runner.cleanup()
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'args': {k: v for k, v in vars(args).items() if k != 'json'}, 'levels': results}, f, indent=2)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--concurrency', type=lambda s: [int(x) for x in s.split(',')], default=[1, 10, 50],
+                        help='comma-separated numbers of concurrent users')
+    parser.add_argument('--duration', type=float, default=15, help='seconds per concurrency level')
+    parser.add_argument('--step-timeout', type=float, default=10)
+    parser.add_argument('--nbu-latency', type=float, default=0.1, help='seconds per NBU response')
+    parser.add_argument('--nbu-error-rate', type=float, default=0.0)
+    parser.add_argument('--tg-latency', type=float, default=0.03, help='seconds per Bot API response')
+    parser.add_argument('--tg-error-rate', type=float, default=0.0)
+    parser.add_argument('--log-level', default='WARNING')
+    parser.add_argument('--json', help='write results as JSON')
+    args = parser.parse_args()
+
+    # The bot's SQLite files and chart cache go to a scratch directory
+    with tempfile.TemporaryDirectory(prefix='bench-webhook-') as workdir:
+        os.chdir(workdir)
+        asyncio.run(run(args))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+"""
+Replaying recorded webhook traffic against a test instance
+
+    RECORD_UPDATES_PATH=updates.jsonl uvicorn main:app           # production: record
+    python benchmarks/replay_updates.py updates.jsonl --url http://127.0.0.1:8000/webhook --speed 5
+
+Updates are posted with their original spacing divided by --speed (0 = as fast as
+possible), so real load shapes (bursts, abandoned dialogs, double taps, custom
+dates) are reproduced. update_ids are shifted by --id-offset (default: derived from
+the current time) so that the instance's dedupe window does not swallow a second
+replay, while redeliveries inside the recording stay duplicates.
+
+Point the test instance at a local Bot API stand-in (TELEGRAM_API_URL), otherwise
+its replies go to real Telegram chats and fail for the hashed ids.
+"""
+import argparse
+import asyncio
+import json
+import time
+from collections import Counter
+from typing import List, Tuple
+
+from aiohttp import ClientSession, ClientTimeout
+
+
+def load(path: str, limit: int) -> List[Tuple[float, dict]]:
+    records = []
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                received_at, update = json.loads(line)
+                records.append((received_at, update))
+                if limit and len(records) >= limit:
+                    break
+    return records
+
+
+async def replay(args):
+    records = load(args.file, args.limit)
+    if not records:
+        print("No updates to replay")
+        return
+
+    id_offset = args.id_offset if args.id_offset is not None else int(time.time()) * 1000
+    headers = {'Content-Type': 'application/json'}
+    if args.secret:
+        headers['X-Telegram-Bot-Api-Secret-Token'] = args.secret
+
+    statuses = Counter()
+    latencies = []
+    behind = []
+    semaphore = asyncio.Semaphore(args.max_in_flight)
+    first_at = records[0][0]
+    started = time.monotonic()
+
+    async def post(session: ClientSession, update: dict):
+        async with semaphore:
+            sent_at = time.monotonic()
+            try:
+                async with session.post(args.url, data=json.dumps(update), headers=headers) as response:
+                    statuses[response.status] += 1
+            except Exception as e:
+                statuses[type(e).__name__] += 1
+            latencies.append(time.monotonic() - sent_at)
+
+    tasks = []
+    async with ClientSession(timeout=ClientTimeout(total=30)) as session:
+        for received_at, update in records:
+            if args.speed:
+                due = started + (received_at - first_at) / args.speed
+                delay = due - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                behind.append(max(0.0, -delay))
+            update = dict(update, update_id=update['update_id'] + id_offset)
+            tasks.append(asyncio.create_task(post(session, update)))
+        await asyncio.gather(*tasks)
+
+    elapsed = time.monotonic() - started
+    recorded_span = records[-1][0] - first_at
+    latencies.sort()
+    p = lambda q: latencies[min(len(latencies) - 1, int(q * len(latencies)))] * 1000  # noqa: E731
+    print(f"Replayed {len(records)} updates in {elapsed:.1f} s "
+          f"(recorded over {recorded_span:.1f} s, {len(records) / max(elapsed, 1e-9):.1f} updates/s)")
+    print(f"Statuses: {dict(statuses)}")
+    print(f"Webhook response: p50 {p(0.5):.1f} ms, p99 {p(0.99):.1f} ms")
+    if behind:
+        print(f"Behind schedule: max {max(behind) * 1000:.0f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('file', help='recording made with RECORD_UPDATES_PATH')
+    parser.add_argument('--url', default='http://127.0.0.1:8000/webhook')
+    parser.add_argument('--speed', type=float, default=1.0, help='1 = real time, 10 = ten times faster, 0 = no pauses')
+    parser.add_argument('--secret', help='WEBHOOK_SECRET of the test instance')
+    parser.add_argument('--id-offset', type=int, help='added to every update_id')
+    parser.add_argument('--limit', type=int, default=0, help='replay only the first N updates')
+    parser.add_argument('--max-in-flight', type=int, default=200)
+    asyncio.run(replay(parser.parse_args()))
+
+
+if __name__ == '__main__':
+    main()
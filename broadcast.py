@@ -0,0 +1,234 @@
+import asyncio
+import logging
+import os
+import time
+from datetime import datetime, timedelta
+from typing import List, Optional
+
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError
+
+from customs_calculator_bot import bot, format_rates, get_db, get_nbu_rates
+from send_queue import bulk_sends
+
+logger = logging.getLogger(__name__)
+
+# Morning digest hour (server time), hours after it the digest may still go out, and when
+# to start polling for tomorrow's rate
+DIGEST_HOUR = int(os.getenv('DIGEST_HOUR', '9'))
+DIGEST_WINDOW_HOURS = int(os.getenv('DIGEST_WINDOW_HOURS', '1'))
+TOMORROW_RATE_FROM_HOUR = int(os.getenv('TOMORROW_RATE_FROM_HOUR', '15'))
+BROADCAST_CHECK_INTERVAL = int(os.getenv('BROADCAST_CHECK_INTERVAL', '600'))
+# Chats per batch (progress is saved after each batch) and hard limit for one broadcast, seconds
+BROADCAST_BATCH = int(os.getenv('BROADCAST_BATCH', '25'))
+BROADCAST_DEADLINE = int(os.getenv('BROADCAST_DEADLINE', '1800'))
+# A worker owns a broadcast for this long after its last renewal (other workers skip it);
+# the owner renews it every BROADCAST_LEASE / 4 seconds while sending
+BROADCAST_LEASE = 120
+# Resume cursor of a new broadcast: below every chat id (groups and channels are negative)
+CURSOR_START = -2 ** 63
+
+
+def create_broadcast(kind: str, rate_date: datetime, text: str) -> bool:
+    """Storing a rendered broadcast once per (kind, date); False if it already exists"""
+    with get_db('broadcast') as conn:
+        created = conn.execute(
+            'INSERT OR IGNORE INTO broadcasts (kind, rate_date, text, last_chat_id) VALUES (?, ?, ?, ?)',
+            (kind, rate_date.strftime('%Y-%m-%d'), text, CURSOR_START)
+        ).rowcount
+        conn.commit()
+    return bool(created)
+
+
+def broadcast_exists(kind: str, rate_date: datetime) -> bool:
+    with get_db('broadcast') as conn:
+        return conn.execute(
+            'SELECT 1 FROM broadcasts WHERE kind = ? AND rate_date = ?', (kind, rate_date.strftime('%Y-%m-%d'))
+        ).fetchone() is not None
+
+
+def claim_broadcast(broadcast_id: int) -> Optional[float]:
+    """
+    Taking the lease on an unfinished broadcast (one sender across workers)
+
+    Returns the lease expiry, which also identifies the owner: renewals and
+    releases only apply while lease_until still holds that value.
+    """
+    now = time.time()
+    lease_until = now + BROADCAST_LEASE
+    with get_db('broadcast') as conn:
+        claimed = conn.execute(
+            '''
+            UPDATE broadcasts
+            SET lease_until = ?
+            WHERE id = ? AND finished_at IS NULL AND (lease_until IS NULL OR lease_until < ?)
+            ''', (lease_until, broadcast_id, now)
+        ).rowcount
+        conn.commit()
+    return lease_until if claimed else None
+
+
+def renew_lease(broadcast_id: int, lease_until: float) -> Optional[float]:
+    """Extending our lease; None if it was lost to another worker"""
+    renewed_until = time.time() + BROADCAST_LEASE
+    with get_db('broadcast') as conn:
+        renewed = conn.execute(
+            'UPDATE broadcasts SET lease_until = ? WHERE id = ? AND lease_until = ?',
+            (renewed_until, broadcast_id, lease_until)
+        ).rowcount
+        conn.commit()
+    return renewed_until if renewed else None
+
+
+async def keep_lease(broadcast_id: int, lease: List[float], lost: asyncio.Event):
+    """Renewing the lease while sends run, however long a batch waits on flood limits"""
+    while True:
+        await asyncio.sleep(BROADCAST_LEASE / 4)
+        try:
+            renewed_until = renew_lease(broadcast_id, lease[0])
+        except Exception as e:
+            logger.error(f"Помилка продовження оренди розсилки {broadcast_id}: {e}")
+            continue
+        if renewed_until is None:
+            logger.warning(f"Оренду розсилки {broadcast_id} втрачено")
+            lost.set()
+            return
+        lease[0] = renewed_until
+
+
+async def send_one(chat_id: int, text: str) -> str:
+    """Sending one broadcast message: 'sent', 'blocked' or 'failed'"""
+    try:
+        await bot.send_message(chat_id, text, parse_mode="HTML")
+        return 'sent'
+    except TelegramForbiddenError:
+        # Bot blocked by the user or kicked from the group
+        return 'blocked'
+    except TelegramBadRequest as e:
+        if 'chat not found' in str(e).lower():
+            return 'blocked'
+        logger.error(f"Помилка розсилки в чат {chat_id}: {e}")
+        return 'failed'
+    except Exception as e:
+        logger.error(f"Помилка розсилки в чат {chat_id}: {e}")
+        return 'failed'
+
+
+async def run_broadcast(broadcast_id: int):
+    """
+    Fan-out of one broadcast in chat_id order, resuming after last_chat_id
+
+    After BROADCAST_DEADLINE seconds the lease is released and the rest is sent by
+    a later run; the broadcast is finished only when no subscribers are left.
+    """
+    lease_until = claim_broadcast(broadcast_id)
+    if lease_until is None:
+        return
+
+    with get_db('broadcast') as conn:
+        row = conn.execute('SELECT kind, text, last_chat_id FROM broadcasts WHERE id = ?', (broadcast_id,)).fetchone()
+    text, last_chat_id = row['text'], row['last_chat_id']
+    started = time.monotonic()
+    logger.info(f"📣 Розсилка {broadcast_id} ({row['kind']}) з чату {last_chat_id}")
+
+    # Mutable, so that the keeper and the progress updates share the current value
+    lease = [lease_until]
+    lost = asyncio.Event()
+    keeper = asyncio.create_task(keep_lease(broadcast_id, lease, lost))
+    try:
+        exhausted = await send_batches(broadcast_id, text, last_chat_id, started, lease, lost)
+    finally:
+        keeper.cancel()
+        await asyncio.gather(keeper, return_exceptions=True)
+    if lost.is_set():
+        return
+
+    with get_db('broadcast') as conn:
+        if not exhausted:
+            # Deadline: let any worker resume it later
+            conn.execute('UPDATE broadcasts SET lease_until = NULL WHERE id = ? AND lease_until = ?',
+                         (broadcast_id, lease[0]))
+            conn.commit()
+            return
+        conn.execute('UPDATE broadcasts SET finished_at = CURRENT_TIMESTAMP, lease_until = NULL WHERE id = ?',
+                     (broadcast_id,))
+        conn.commit()
+        row = conn.execute('SELECT sent, failed, blocked FROM broadcasts WHERE id = ?', (broadcast_id,)).fetchone()
+    logger.info(f"✅ Розсилка {broadcast_id}: надіслано {row['sent']}, помилок {row['failed']}, "
+                f"заблоковано {row['blocked']} за {time.monotonic() - started:.1f} с")
+
+
+async def send_batches(broadcast_id: int, text: str, last_chat_id: int, started: float, lease: List[float],
+                       lost: asyncio.Event) -> bool:
+    """Sending batch after batch; True once every subscriber got it, False on the deadline or a lost lease"""
+    # Sends are low priority: interactive replies go first
+    with bulk_sends():
+        while True:
+            with get_db('broadcast') as conn:
+                chat_ids: List[int] = [r[0] for r in conn.execute(
+                    'SELECT chat_id FROM subscriptions WHERE active = 1 AND chat_id > ? ORDER BY chat_id LIMIT ?',
+                    (last_chat_id, BROADCAST_BATCH)
+                ).fetchall()]
+            if not chat_ids:
+                return True
+
+            results = await asyncio.gather(*(send_one(chat_id, text) for chat_id in chat_ids))
+            blocked = [chat_id for chat_id, result in zip(chat_ids, results) if result == 'blocked']
+            last_chat_id = chat_ids[-1]
+
+            renewed_until = time.time() + BROADCAST_LEASE
+            with get_db('broadcast') as conn:
+                if blocked:
+                    conn.executemany('UPDATE subscriptions SET active = 0 WHERE chat_id = ?', [(c,) for c in blocked])
+                updated = conn.execute(
+                    '''
+                    UPDATE broadcasts
+                    SET last_chat_id = ?, sent = sent + ?, failed = failed + ?, blocked = blocked + ?, lease_until = ?
+                    WHERE id = ? AND lease_until = ?
+                    ''', (last_chat_id, results.count('sent'), results.count('failed'), len(blocked),
+                          renewed_until, broadcast_id, lease[0])
+                ).rowcount
+                conn.commit()
+            if not updated:
+                # Another worker took over (our lease had expired): its progress wins
+                logger.warning(f"Оренду розсилки {broadcast_id} втрачено")
+                lost.set()
+                return False
+            lease[0] = renewed_until
+
+            if time.monotonic() - started > BROADCAST_DEADLINE:
+                logger.warning(f"⏱️ Розсилка {broadcast_id} призупинена після {BROADCAST_DEADLINE} с (чат {last_chat_id})")
+                return False
+
+
+async def prepare_broadcasts(now: Optional[datetime] = None):
+    """Rendering today's digest and tomorrow's rate alert once they are due"""
+    now = now or datetime.now()
+
+    # A "good morning" digest is skipped for the day if the window was missed (e.g. a late start)
+    if DIGEST_HOUR <= now.hour < DIGEST_HOUR + DIGEST_WINDOW_HOURS and not broadcast_exists('digest', now):
+        usd_rate, eur_rate = await get_nbu_rates(now)
+        if usd_rate and eur_rate:
+            create_broadcast('digest', now, "☀️ <b>Доброго ранку!</b>\n\n" + format_rates(now, usd_rate, eur_rate))
+
+    tomorrow = now + timedelta(days=1)
+    if now.hour >= TOMORROW_RATE_FROM_HOUR and not broadcast_exists('tomorrow', tomorrow):
+        usd_rate, eur_rate = await get_nbu_rates(tomorrow)
+        if usd_rate and eur_rate:
+            create_broadcast('tomorrow', tomorrow,
+                             "🔔 <b>НБУ опублікував курс на завтра</b>\n\n" + format_rates(tomorrow, usd_rate, eur_rate))
+
+
+async def broadcast_loop():
+    """Scheduler: prepares due broadcasts and runs (or resumes) unfinished ones"""
+    while True:
+        try:
+            await prepare_broadcasts()
+            with get_db('broadcast') as conn:
+                pending = [r[0] for r in conn.execute(
+                    'SELECT id FROM broadcasts WHERE finished_at IS NULL ORDER BY id'
+                ).fetchall()]
+            for broadcast_id in pending:
+                await run_broadcast(broadcast_id)
+        except Exception as e:
+            logger.error(f"Помилка планувальника розсилок: {e}")
+        await asyncio.sleep(BROADCAST_CHECK_INTERVAL)
@@ -0,0 +1,34 @@
+import io
+from typing import Dict, List
+
+
+# Rendering runs in a worker process (see get_chart_pool in customs_calculator_bot),
+# so this module must not import the bot itself
+def render_line_chart(title: str, labels: List[str], series: Dict[str, List[float]], ylabel: str) -> bytes:
+    """Line chart as PNG bytes"""
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+
+    fig, ax = plt.subplots(figsize=(8, 4.5), dpi=100)
+    try:
+        positions = range(len(labels))
+        for name, values in series.items():
+            ax.plot(positions, values, label=name, linewidth=2)
+
+        # No more than ~10 date labels on the axis
+        step = max(1, len(labels) // 10)
+        ax.set_xticks(list(positions)[::step])
+        ax.set_xticklabels(labels[::step], rotation=45, ha="right")
+
+        ax.set_title(title)
+        ax.set_ylabel(ylabel)
+        ax.grid(True, alpha=0.3)
+        if len(series) > 1:
+            ax.legend()
+
+        buffer = io.BytesIO()
+        fig.savefig(buffer, format="png", bbox_inches="tight")
+        return buffer.getvalue()
+    finally:
+        plt.close(fig)
@@ -1,17 +1,32 @@
 import os
 import logging
 from datetime import datetime, timedelta
-from typing import Dict, Optional
+from typing import Dict, List, Optional, Tuple
 import aiohttp
 from aiogram import Bot, Dispatcher, types, F
-from aiogram.filters import Command, StateFilter
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import PRODUCTION, TelegramAPIServer
+from aiogram.filters import Command, CommandObject, StateFilter
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
-from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram.types import ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardMarkup, InlineKeyboardButton
 from dotenv import load_dotenv
+from charts import render_line_chart
+from fsm_storage import SQLiteStorage, TTLMemoryStorage
+from metrics import (HandlerMetricsMiddleware, UpdateMetricsMiddleware, cache_requests_total, db_seconds,
+                     nbu_errors_total, nbu_request_seconds)
+from throttling import ThrottlingMiddleware
+from tracing import HandlerSpanMiddleware, TracingMiddleware, span
+from send_queue import SendScheduler
 import asyncio
+import atexit
+import hashlib
+import html
+import math
 import sqlite3
+import time
+from collections import OrderedDict
+from concurrent.futures import Executor
 from contextlib import contextmanager
 
 # Loading environment variables
@@ -26,10 +41,83 @@ BOT_TOKEN = os.getenv('BOT_TOKEN')
 DEVELOPER_ID = int(os.getenv('DEVELOPER_ID', '0'))
 CARRIER_USERNAME = os.getenv('CARRIER_USERNAME', 'carrier')
 
-bot = Bot(token=BOT_TOKEN)
-storage = MemoryStorage()
+# API base URLs (overridden by local stand-ins in benchmarks)
+TELEGRAM_API_URL = os.getenv('TELEGRAM_API_URL')
+NBU_API_URL = os.getenv('NBU_API_URL', 'https://bank.gov.ua').rstrip('/')
+
+# Exchange rate cache and inline mode settings
+RATE_CACHE_TTL = int(os.getenv('RATE_CACHE_TTL', '3600'))
+RATE_CACHE_SIZE = int(os.getenv('RATE_CACHE_SIZE', '2000'))
+NBU_TIMEOUT = float(os.getenv('NBU_TIMEOUT', '10'))
+INLINE_CACHE_TIME = int(os.getenv('INLINE_CACHE_TIME', '3600'))
+INLINE_RATE_TIMEOUT = float(os.getenv('INLINE_RATE_TIMEOUT', '2.5'))
+QUOTE_CACHE_SIZE = int(os.getenv('QUOTE_CACHE_SIZE', '1000'))
+
+# FSM storage: SQLite file shared by all workers (if set) or process memory
+FSM_STORAGE_PATH = os.getenv('FSM_STORAGE_PATH')
+FSM_TTL = int(os.getenv('FSM_TTL', '86400'))
+FSM_MAX_SESSIONS = int(os.getenv('FSM_MAX_SESSIONS', '100000'))
+
+# Throttling: tokens per second and burst, per user and for the whole bot
+THROTTLE_RATE = float(os.getenv('THROTTLE_RATE', '1'))
+THROTTLE_BURST = float(os.getenv('THROTTLE_BURST', '5'))
+THROTTLE_GLOBAL_RATE = float(os.getenv('THROTTLE_GLOBAL_RATE', '50'))
+THROTTLE_GLOBAL_BURST = float(os.getenv('THROTTLE_GLOBAL_BURST', '100'))
+
+# Outbound Bot API: pooled connections and send pacing (messages per second)
+BOT_API_CONNECTIONS = int(os.getenv('BOT_API_CONNECTIONS', '100'))
+SEND_GLOBAL_RATE = float(os.getenv('SEND_GLOBAL_RATE', '30'))
+SEND_CHAT_RATE = float(os.getenv('SEND_CHAT_RATE', '1'))
+
+# Tracing: updates slower than this are logged with their breakdown; every N-th update profiled (0 = off)
+SLOW_UPDATE_SECONDS = float(os.getenv('SLOW_UPDATE_SECONDS', '2'))
+PROFILE_EVERY_N = int(os.getenv('PROFILE_EVERY_N', '0'))
+PROFILE_DIR = os.getenv('PROFILE_DIR', 'profiles')
+
+# Warm-start snapshot: newest calculations carried over from the in-memory history
+SNAPSHOT_HISTORY_SIZE = int(os.getenv('SNAPSHOT_HISTORY_SIZE', '1000'))
+
+# Chart rendering settings
+CHART_WORKERS = int(os.getenv('CHART_WORKERS', '1'))
+CHART_CACHE_SIZE = int(os.getenv('CHART_CACHE_SIZE', '50'))
+POPULAR_CHART_DAYS = int(os.getenv('POPULAR_CHART_DAYS', '30'))
+# Users whose last /sweep is kept for its "📈 Графік" button
+SWEEP_CACHE_SIZE = int(os.getenv('SWEEP_CACHE_SIZE', '1000'))
+
+# One pooled Bot API session; every send goes through the rate-limiting scheduler
+send_scheduler = SendScheduler(global_rate=SEND_GLOBAL_RATE, global_burst=SEND_GLOBAL_RATE, chat_rate=SEND_CHAT_RATE)
+bot_session = AiohttpSession(
+    api=TelegramAPIServer.from_base(TELEGRAM_API_URL) if TELEGRAM_API_URL else PRODUCTION,
+    limit=BOT_API_CONNECTIONS
+)
+bot_session.middleware(send_scheduler)
+bot = Bot(token=BOT_TOKEN, session=bot_session)
+if FSM_STORAGE_PATH:
+    storage = SQLiteStorage(FSM_STORAGE_PATH, ttl=FSM_TTL)
+else:
+    storage = TTLMemoryStorage(ttl=FSM_TTL, max_sessions=FSM_MAX_SESSIONS)
 dp = Dispatcher(storage=storage)
 
+# Throttling of messages and button presses (inline queries are cached by Telegram instead)
+throttling = ThrottlingMiddleware(
+    rate=THROTTLE_RATE,
+    burst=THROTTLE_BURST,
+    global_rate=THROTTLE_GLOBAL_RATE,
+    global_burst=THROTTLE_GLOBAL_BURST
+)
+dp.message.outer_middleware(throttling)
+dp.callback_query.outer_middleware(throttling)
+
+# Tracing (span tree per update) and metrics: update counts by type, latency of every handler
+tracing = TracingMiddleware(slow_threshold=SLOW_UPDATE_SECONDS, profile_every=PROFILE_EVERY_N, profile_dir=PROFILE_DIR)
+dp.update.outer_middleware(tracing)
+dp.update.outer_middleware(UpdateMetricsMiddleware())
+handler_metrics = HandlerMetricsMiddleware()
+handler_span = HandlerSpanMiddleware()
+for observer in (dp.message, dp.callback_query, dp.inline_query):
+    observer.middleware(handler_metrics)
+    observer.middleware(handler_span)
+
 # In-memory calculation database (backup storage)
 calculations_db = []
 
@@ -195,19 +283,59 @@ def init_db():
                    CREATE INDEX IF NOT EXISTS idx_created_at ON calculations(created_at)
                    ''')
 
+    # Subscribers of the daily NBU rate digest
+    cursor.execute('''
+                   CREATE TABLE IF NOT EXISTS subscriptions
+                   (
+                       chat_id    INTEGER PRIMARY KEY,
+                       user_id    INTEGER,
+                       active     INTEGER NOT NULL DEFAULT 1,
+                       created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                   )
+                   ''')
+
+    # Broadcast progress (resumable): chats are sent in chat_id order after last_chat_id,
+    # which starts below every chat id (group and channel ids are negative)
+    cursor.execute('''
+                   CREATE TABLE IF NOT EXISTS broadcasts
+                   (
+                       id           INTEGER PRIMARY KEY AUTOINCREMENT,
+                       kind         TEXT    NOT NULL,
+                       rate_date    TEXT    NOT NULL,
+                       text         TEXT    NOT NULL,
+                       last_chat_id INTEGER NOT NULL DEFAULT -9223372036854775808,
+                       sent         INTEGER NOT NULL DEFAULT 0,
+                       failed       INTEGER NOT NULL DEFAULT 0,
+                       blocked      INTEGER NOT NULL DEFAULT 0,
+                       lease_until  REAL,
+                       created_at   TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                       finished_at  TIMESTAMP,
+                       UNIQUE (kind, rate_date)
+                   )
+                   ''')
+    # Broadcasts created with the old default of 0 would skip groups: not yet started ones start over
+    cursor.execute('''
+                   UPDATE broadcasts
+                   SET last_chat_id = -9223372036854775808
+                   WHERE last_chat_id = 0 AND sent = 0 AND failed = 0 AND blocked = 0 AND finished_at IS NULL
+                   ''')
+
     conn.commit()
     conn.close()
 
 
 @contextmanager
-def get_db():
-    """Context manager for working with databases"""
+def get_db(query: str = 'other'):
+    """Context manager for working with databases (the block is timed as `query`)"""
+    started = time.perf_counter()
     conn = sqlite3.connect('customs_bot.db')
     conn.row_factory = sqlite3.Row
     try:
-        yield conn
+        with span(f"db:{query}"):
+            yield conn
     finally:
         conn.close()
+        db_seconds.observe(time.perf_counter() - started, query)
 
 
 # FSM states
@@ -222,25 +350,150 @@ class CalculationStates(StatesGroup):
     entering_battery = State()
     choosing_date = State()
     custom_date = State()
+    entering_comparison = State()
 
 
-# Function for obtaining the NBU exchange rate
-async def get_nbu_rate(currency: str, date: datetime) -> Optional[float]:
-    """Obtaining exchange rates from the NBU"""
-    try:
-        date_str = date.strftime('%Y%m%d')
-        url = f"https://bank.gov.ua/NBUStatService/v1/statdirectory/exchange?valcode={currency}&date={date_str}&json"
+# Exchange rate cache: (currency, YYYYMMDD) -> (rate, fetched_at)
+# Past dates never change, today's/future rates are refreshed after RATE_CACHE_TTL.
+# Least recently used days are evicted above RATE_CACHE_SIZE (a /sweep alone adds up to 730)
+rate_cache: "OrderedDict[Tuple[str, str], Tuple[float, float]]" = OrderedDict()
+_rate_inflight: Dict[Tuple[str, str], asyncio.Future] = {}
+
+# Shared HTTP session for the NBU API (one connection pool instead of a session per request)
+_http_session: Optional[aiohttp.ClientSession] = None
+
 
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url) as response:
+def get_http_session() -> aiohttp.ClientSession:
+    """Shared aiohttp session for outbound NBU requests"""
+    global _http_session
+    if _http_session is None or _http_session.closed:
+        _http_session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=NBU_TIMEOUT))
+    return _http_session
+
+
+async def close_http_session():
+    """Closing the NBU session (on shutdown)"""
+    global _http_session
+    if _http_session is not None:
+        await _http_session.close()
+        _http_session = None
+
+
+def _cache_rate(key: Tuple[str, str], rate: float, fetched_at: float):
+    """Storing a rate, evicting the least recently used ones over RATE_CACHE_SIZE"""
+    rate_cache[key] = (rate, fetched_at)
+    rate_cache.move_to_end(key)
+    while len(rate_cache) > RATE_CACHE_SIZE:
+        rate_cache.popitem(last=False)
+
+
+def _rate_is_fresh(date_str: str, fetched_at: float) -> bool:
+    """Rates for past days are final, today's and future ones may still change"""
+    if date_str < datetime.now().strftime('%Y%m%d'):
+        return True
+    return time.monotonic() - fetched_at < RATE_CACHE_TTL
+
+
+def get_cached_rate(currency: str, date: datetime) -> Optional[float]:
+    """Exchange rate from the cache only (no network)"""
+    cached = rate_cache.get((currency, date.strftime('%Y%m%d')))
+    if cached and _rate_is_fresh(date.strftime('%Y%m%d'), cached[1]):
+        return cached[0]
+    return None
+
+
+async def _fetch_nbu_rate(currency: str, date_str: str) -> Optional[float]:
+    """Single NBU API request"""
+    url = f"{NBU_API_URL}/NBUStatService/v1/statdirectory/exchange?valcode={currency}&date={date_str}&json"
+    with nbu_request_seconds.time('exchange'), span(f"nbu:exchange {currency}"):
+        try:
+            async with get_http_session().get(url) as response:
                 if response.status == 200:
                     data = await response.json()
                     if data and len(data) > 0:
                         return data[0]['rate']
-        return None
+        except Exception:
+            nbu_errors_total.inc('exchange')
+            raise
+    nbu_errors_total.inc('exchange')
+    return None
+
+
+# Function for obtaining the NBU exchange rate
+async def get_nbu_rate(currency: str, date: datetime) -> Optional[float]:
+    """Obtaining exchange rates from the NBU"""
+    date_str = date.strftime('%Y%m%d')
+    key = (currency, date_str)
+
+    cached = rate_cache.get(key)
+    if cached and _rate_is_fresh(date_str, cached[1]):
+        cache_requests_total.inc('rate', 'hit')
+        rate_cache.move_to_end(key)
+        return cached[0]
+
+    # Concurrent requests for the same rate share one NBU call
+    inflight = _rate_inflight.get(key)
+    if inflight is not None:
+        cache_requests_total.inc('rate', 'inflight')
+        return await asyncio.shield(inflight)
+    cache_requests_total.inc('rate', 'miss')
+
+    future = asyncio.get_running_loop().create_future()
+    _rate_inflight[key] = future
+    rate = None
+    try:
+        rate = await _fetch_nbu_rate(currency, date_str)
+        if rate:
+            _cache_rate(key, rate, time.monotonic())
     except Exception as e:
         logger.error(f"Помилка отримання курсу: {e}")
-        return None
+    finally:
+        del _rate_inflight[key]
+        future.set_result(rate)
+    return rate
+
+
+async def get_nbu_rate_range(currency: str, start: datetime, end: datetime) -> Dict[str, float]:
+    """Rates for every day of a range (YYYYMMDD -> rate) with one NBU request"""
+    days = [(start + timedelta(days=i)).strftime('%Y%m%d') for i in range((end - start).days + 1)]
+
+    # Everything already cached - local read only
+    cached = {day: rate_cache.get((currency, day)) for day in days}
+    if all(entry and _rate_is_fresh(day, entry[1]) for day, entry in cached.items()):
+        for day in days:
+            rate_cache.move_to_end((currency, day))
+        return {day: entry[0] for day, entry in cached.items()}
+
+    url = (f"{NBU_API_URL}/NBU_Exchange/exchange_site?start={days[0]}&end={days[-1]}"
+           f"&valcode={currency.lower()}&sort=exchangedate&order=asc&json")
+    rates = {}
+    try:
+        with nbu_request_seconds.time('exchange_site'), span(f"nbu:exchange_site {currency}"):
+            async with get_http_session().get(url) as response:
+                if response.status == 200:
+                    now = time.monotonic()
+                    for item in await response.json():
+                        day = datetime.strptime(item['exchangedate'], '%d.%m.%Y').strftime('%Y%m%d')
+                        rate = item.get('rate_per_unit') or item['rate'] / item.get('units', 1)
+                        rates[day] = rate
+                        _cache_rate((currency, day), rate, now)
+                else:
+                    nbu_errors_total.inc('exchange_site')
+    except Exception as e:
+        nbu_errors_total.inc('exchange_site')
+        logger.error(f"Помилка отримання курсів за період: {e}")
+
+    # Fall back to whatever the cache has for days missing in the response
+    for day, entry in cached.items():
+        if day not in rates and entry:
+            rates[day] = entry[0]
+    return rates
+
+
+async def get_nbu_rates(date: datetime) -> Tuple[Optional[float], Optional[float]]:
+    """USD and EUR rates for a date, fetched concurrently"""
+    usd_rate, eur_rate = await asyncio.gather(get_nbu_rate("USD", date), get_nbu_rate("EUR", date))
+    return usd_rate, eur_rate
 
 
 # Function for calculating the coefficient by year of manufacture
@@ -436,6 +689,14 @@ def calculate_electric_motorcycle(cost_uah: float) -> Dict:
     }
 
 
+# Pension fund tiers: (upper bound in UAH, exclusive; rate)
+PENSION_TIERS = (
+    (499620, 0.03),
+    (878120, 0.04),
+    (float('inf'), 0.05),
+)
+
+
 # Pension fund calculation function
 def calculate_pension_fund(cost_uah: float, is_electric: bool = False) -> float:
     """
@@ -452,12 +713,10 @@ def calculate_pension_fund(cost_uah: float, is_electric: bool = False) -> float:
     if is_electric:
         return 0.0
 
-    if cost_uah < 499620:
-        return cost_uah * 0.03
-    elif cost_uah < 878120:
-        return cost_uah * 0.04
-    else:
-        return cost_uah * 0.05
+    for upper_bound, rate in PENSION_TIERS:
+        if cost_uah < upper_bound:
+            return cost_uah * rate
+    return cost_uah * PENSION_TIERS[-1][1]
 
 
 # Main menu
@@ -470,7 +729,8 @@ def get_main_menu() -> ReplyKeyboardMarkup:
         [KeyboardButton(text="💱 Курс валют")],
         #[KeyboardButton(text="🚢 Доставка Європа - Україна")],
         [KeyboardButton(text="💬 Зв'язок із розробником")],
-        [KeyboardButton(text="📜 Історія розрахунків")]
+        [KeyboardButton(text="📜 Історія розрахунків")],
+        [KeyboardButton(text="📊 Порівняння")]
     ]
     return ReplyKeyboardMarkup(keyboard=kb, resize_keyboard=True)
 
@@ -596,6 +856,15 @@ async def show_rates_menu(message: types.Message, state: FSMContext):
     )
 
 
+# Comparison handler (registered before the dialog states, so it works in the middle of a calculation)
+@dp.message(F.text == "📊 Порівняння")
+async def choose_comparison(message: types.Message, state: FSMContext):
+    """Comparison mode from the main menu"""
+    await state.clear()
+    await state.set_state(CalculationStates.entering_comparison)
+    await message.answer(COMPARE_PROMPT, parse_mode="HTML")
+
+
 # "Contact with carrier" handler
 # @dp.message(F.text == "📞 Зв'язок із перевізником")
 # async def contact_carrier(message: types.Message):
@@ -659,7 +928,7 @@ async def show_history(message: types.Message):
 
     # Спроба читати з БД (основний варіант)
     try:
-        with get_db() as conn:
+        with get_db('history') as conn:
             cursor = conn.cursor()
             cursor.execute('''
                 SELECT vehicle_type, total_payments, created_at, year, engine_volume, battery_kwh, 
@@ -683,6 +952,11 @@ async def show_history(message: types.Message):
         await message.answer("📜 Історія розрахунків порожня")
         return
 
+    await message.answer(format_history(user_calcs), parse_mode="HTML")
+
+
+def format_history(user_calcs: List) -> str:
+    """HTML text of the last calculations (sqlite3.Row from the DB or dicts from memory)"""
     history_text = "📜 <b>Ваші останні розрахунки (до 5):</b>\n\n"
 
     for calc in user_calcs:
@@ -737,8 +1011,7 @@ async def show_history(message: types.Message):
         history_text += f"💰 Вартість = {total_uah:.2f} грн\n"
         history_text += f"💵 РАЗОМ митниця: {total_customs:.2f} грн ({customs_in_currency:.2f} {curr_symbol})\n"
         history_text += f"📅 {date_str}\n\n"
-
-    await message.answer(history_text, parse_mode="HTML")
+    return history_text
 
 
 # Statistics Handler (for developer only)
@@ -750,7 +1023,7 @@ async def show_stats(message: types.Message):
         return
 
     try:
-        with get_db() as conn:
+        with get_db('stats') as conn:
             cursor = conn.cursor()
 
             # Total number of calculations
@@ -787,6 +1060,12 @@ async def show_stats(message: types.Message):
 
         for vehicle in popular_vehicles:
             stats_text += f"• {vehicle['vehicle_type']}: {vehicle['count']}\n"
+
+        with get_db('stats') as conn:
+            subscribers = conn.execute('SELECT COUNT(*) FROM subscriptions WHERE active = 1').fetchone()[0]
+        stats_text += f"\n🔔 Підписників на курс: {subscribers}\n"
+
+        stats_text += f"\n💬 Активних діалогів: {await storage.session_count()} (~{await storage.approx_bytes() / 1024:.1f} КБ)\n"
     except:
         # Если БД недоступна, используем память
         total_calcs = len(calculations_db)
@@ -795,10 +1074,129 @@ async def show_stats(message: types.Message):
         stats_text = f"📊 <b>Статистика робота</b>\n\n"
         stats_text += f"👥 Унікальних користувачів: {unique_users}\n"
         stats_text += f"🧮 Усього розрахунків: {total_calcs}\n"
+        stats_text += f"💬 Активних діалогів: {await storage.session_count()} (~{await storage.approx_bytes() / 1024:.1f} КБ)\n"
 
+    stats_text += f"⏳ Обмежено запитів: {throttling.throttled_user} (користувач), {throttling.throttled_global} (глобально)\n"
     await message.answer(stats_text, parse_mode="HTML")
 
 
+# tracemalloc reports for /mem (created on first use, tracing is started on demand)
+allocation_tracker = None
+
+
+def memory_structures() -> Dict[str, object]:
+    """Shallow copies of in-process structures that grow with traffic (safe to walk off the loop)"""
+    return {
+        'calculations_db': calculations_db.copy(),
+        'rate_cache': rate_cache.copy(),
+        'quote_cache': quote_cache.copy(),
+        'chart_cache': chart_cache.copy(),
+        'last_sweeps': last_sweeps.copy(),
+        'throttling': throttling.buckets(),
+        'send_chats': send_scheduler.buckets(),
+    }
+
+
+# Version of the warm-start snapshot sections below: bump it whenever their layout changes
+SNAPSHOT_VERSION = 1
+
+
+def dump_warm_state() -> Dict[str, list]:
+    """Caches and dialogs worth carrying over to the next instance (JSON-friendly)"""
+    now = time.monotonic()
+    today = datetime.now().strftime('%Y%m%d')
+    sections = {
+        # Monotonic fetch times do not survive a restart: their age is stored instead
+        'rates': [[currency, day, rate, round(now - fetched_at, 3)]
+                  for (currency, day), (rate, fetched_at) in rate_cache.items()],
+        # Yesterday's quotes would never be hit again
+        'quotes': [[query, day, [article.model_dump(mode='json', exclude_defaults=True) for article in articles]]
+                   for (query, day), articles in quote_cache.items() if day == today],
+        # The in-memory history is unbounded: only its tail is carried over
+        'history': calculations_db[-SNAPSHOT_HISTORY_SIZE:] if SNAPSHOT_HISTORY_SIZE > 0 else [],
+    }
+    # SQLite storage keeps its dialogs on disk anyway
+    if isinstance(storage, TTLMemoryStorage):
+        sections['fsm'] = storage.dump()
+    return sections
+
+
+def restore_warm_state(sections: Dict[str, list], elapsed: float) -> Dict[str, int]:
+    """Loading a dump_warm_state() taken `elapsed` seconds ago, returns restored counts"""
+    now = time.monotonic()
+    today = datetime.now().strftime('%Y%m%d')
+    restored = {}
+
+    rates = 0
+    for currency, day, rate, age in sections.get('rates', []):
+        fetched_at = now - age - elapsed
+        if (currency, day) not in rate_cache and _rate_is_fresh(day, fetched_at):
+            _cache_rate((currency, day), rate, fetched_at)
+            rates += 1
+    restored['rates'] = rates
+
+    for query, day, articles in sections.get('quotes', [])[-QUOTE_CACHE_SIZE:]:
+        if day == today and (query, day) not in quote_cache:
+            quote_cache[(query, day)] = [types.InlineQueryResultArticle.model_validate(a) for a in articles]
+    restored['quotes'] = len(quote_cache)
+
+    # Older entries go first, like they were appended
+    history = sections.get('history', [])[-SNAPSHOT_HISTORY_SIZE:] if SNAPSHOT_HISTORY_SIZE > 0 else []
+    calculations_db[:0] = history
+    restored['history'] = len(history)
+
+    if 'fsm' in sections and isinstance(storage, TTLMemoryStorage):
+        restored['fsm'] = storage.restore(sections['fsm'], elapsed)
+    return restored
+
+
+# Memory report (for developer only)
+@dp.message(Command("mem"))
+async def show_memory(message: types.Message, command: CommandObject):
+    """Sizes of in-process structures and tracemalloc allocation sites; /mem start|stop"""
+    if message.from_user.id != DEVELOPER_ID:
+        await message.answer("❌ У вас немає доступу до статистики")
+        return
+
+    # Developer-only tool: not imported at startup
+    from memstats import AllocationTracker, deep_size, format_bytes, rss_bytes
+    global allocation_tracker
+    if allocation_tracker is None:
+        allocation_tracker = AllocationTracker()
+
+    action = (command.args or '').strip().lower()
+    if action == 'start':
+        allocation_tracker.start()
+        await message.answer("🔬 tracemalloc увімкнено. Наступні /mem покажуть приріст між звітами.")
+        return
+    if action == 'stop':
+        allocation_tracker.stop()
+        await message.answer("🔬 tracemalloc вимкнено")
+        return
+
+    rss = rss_bytes()
+    lines = [f"RSS: {format_bytes(rss) if rss is not None else '—'}", ""]
+    structures = memory_structures()
+    # Walking large structures takes a while: the copies are measured in a thread
+    sizes = await asyncio.get_running_loop().run_in_executor(
+        None, lambda: {name: deep_size(value) for name, value in structures.items()}
+    )
+    for name, value in structures.items():
+        lines.append(f"{name:<16}{len(value):>7}  {format_bytes(sizes[name]):>9}")
+    lines.append(f"{'fsm':<16}{await storage.session_count():>7}  {format_bytes(await storage.approx_bytes()):>9}")
+
+    if allocation_tracker.tracing:
+        # Snapshots of a large heap take a while, the loop keeps serving meanwhile
+        top, diff = await asyncio.get_running_loop().run_in_executor(None, allocation_tracker.report)
+        lines += ["", "Top allocations:"] + top
+        lines += ["", "Since last /mem:"] + (diff or ["(перший знімок)"])
+    else:
+        lines += ["", "tracemalloc вимкнено: /mem start"]
+
+    text = "\n".join(lines)[:3900]
+    await message.answer(f"🧠 <b>Пам'ять</b>\n\n<pre>{html.escape(text)}</pre>", parse_mode="HTML")
+
+
 # Callback handler for vehicle types
 @dp.callback_query(F.data.startswith("car_"))
 async def process_car_type(callback: types.CallbackQuery, state: FSMContext):
@@ -1153,6 +1551,8 @@ async def process_battery(message: types.Message, state: FSMContext):
 async def process_date_choice(callback: types.CallbackQuery, state: FSMContext):
     """Date selection processing"""
     date_choice = callback.data.replace("date_", "")
+    # The button spinner stops right away, the result replaces the date menu in place
+    await callback.answer()
 
     # We check if there is an active calculation
     data = await state.get_data()
@@ -1174,13 +1574,11 @@ async def process_date_choice(callback: types.CallbackQuery, state: FSMContext):
 
         # If there is data for calculation, we perform the calculation.
         if 'vehicle_type' in data:
-            await perform_calculation(callback.message, state, date)
+            await perform_calculation(callback.message, data, date, callback.from_user, edit=True)
             await state.clear()
         else:
             # Otherwise, we just show the rate
-            await show_rate_only(callback.message, date)
-
-    await callback.answer()
+            await show_rate_only(callback.message, date, edit=True)
 
 
 # Custom Date Handler
@@ -1192,7 +1590,7 @@ async def process_custom_date(message: types.Message, state: FSMContext):
 
         data = await state.get_data()
         if 'vehicle_type' in data:
-            await perform_calculation(message, state, date)
+            await perform_calculation(message, data, date, message.from_user)
             await state.clear()
         else:
             await show_rate_only(message, date)
@@ -1201,22 +1599,58 @@ async def process_custom_date(message: types.Message, state: FSMContext):
 
 
 # Function to display the exchange rate without calculation
-async def show_rate_only(message: types.Message, date: datetime):
+async def show_rate_only(message: types.Message, date: datetime, edit: bool = False):
     """Show only the exchange rate without calculation"""
-    usd_rate = await get_nbu_rate("USD", date)
-    eur_rate = await get_nbu_rate("EUR", date)
+    message, edit = await show_progress(message, date, edit)
+    usd_rate, eur_rate = await get_nbu_rates(date)
 
     if not usd_rate or not eur_rate:
-        await message.answer("❌ Помилка отримання курсу валют")
+        await answer_or_edit(message, "❌ Помилка отримання курсу валют", edit)
         return
 
+    await answer_or_edit(message, format_rates(date, usd_rate, eur_rate), edit)
+
+
+PROGRESS_TEXT = "⏳ Отримую курс НБУ…"
+
+
+def rates_cached(date: datetime) -> bool:
+    return get_cached_rate("USD", date) is not None and get_cached_rate("EUR", date) is not None
+
+
+async def show_progress(message: types.Message, date: datetime, edit: bool) -> Tuple[types.Message, bool]:
+    """
+    Placeholder while NBU rates are fetched (only when they are not cached)
+
+    With edit=True `message` is the bot's own message and it is edited in place;
+    otherwise a placeholder is sent and becomes the message to edit with the result.
+    """
+    if rates_cached(date):
+        return message, edit
+    if edit:
+        await message.edit_text(PROGRESS_TEXT)
+        return message, True
+    return await message.answer(PROGRESS_TEXT), True
+
+
+async def answer_or_edit(message: types.Message, text: str, edit: bool):
+    """Final reply: edit the placeholder in place or answer with the main menu"""
+    if edit:
+        # The reply keyboard stays on screen, edited messages cannot carry it
+        await message.edit_text(text, parse_mode="HTML")
+    else:
+        await message.answer(text, parse_mode="HTML", reply_markup=get_main_menu())
+
+
+def format_rates(date: datetime, usd_rate: float, eur_rate: float) -> str:
+    """HTML text with the NBU rates for a date"""
     response = f"💱 <b>Курс НБУ на {date.strftime('%d.%m.%Y')}</b>\n\n"
     response += f"🇺🇸 1 USD = {usd_rate:.4f} грн\n"
     response += f"🇪🇺 1 EUR = {eur_rate:.4f} грн\n\n"
     response += f"💵 100 USD = {usd_rate * 100:.2f} грн\n"
-    response += f"💶 100 EUR = {eur_rate * 100:.2f} грн"
-
-    await message.answer(response, parse_mode="HTML", reply_markup=get_main_menu())
+    response += f"💶 100 EUR = {eur_rate * 100:.2f} грн\n\n"
+    response += f"📈 Графік за {POPULAR_CHART_DAYS} днів: /chart"
+    return response
 
 
 # Calculation execution function
@@ -1479,17 +1913,8 @@ async def show_rate_only(message: types.Message, date: datetime):
 #         logger.error(f"❌ Помилка збереження у БД: {e}")
 
 
-async def perform_calculation(message: types.Message, state: FSMContext, date: datetime):
-    """Calculation of customs duties"""
-    data = await state.get_data()
-
-    # Получение курсов валют
-    usd_rate = await get_nbu_rate("USD", date)
-    eur_rate = await get_nbu_rate("EUR", date)
-    if not usd_rate or not eur_rate:
-        await message.answer("❌ Помилка отримання курсу валют")
-        return
-
+def compute_customs(data: Dict, usd_rate: float, eur_rate: float) -> Dict:
+    """Pure customs calculation for the FSM data dict (no I/O)"""
     # Converting the cost to hryvnia
     cost = data['cost']
     currency = data['currency']
@@ -1523,54 +1948,33 @@ async def perform_calculation(message: types.Message, state: FSMContext, date: d
     excise_uah = 0.0
     vat = 0.0
     pension = 0.0
-    total_customs = 0.0
 
     if vehicle_type == "car_petrol":
         result = calculate_petrol_car(total_uah, data['engine_volume'], data['year'])
-        duty = result['duty']
-        excise_uah = result['excise_eur'] * eur_rate
     elif vehicle_type == "car_diesel":
         result = calculate_diesel_car(total_uah, data['engine_volume'], data['year'])
-        duty = result['duty']
-        excise_uah = result['excise_eur'] * eur_rate
     elif vehicle_type.startswith("car_electric"):
         with_benefits = vehicle_type == "car_electric_benefits"  # Точна перевірка
         result = calculate_electric_car(total_uah, data['battery_kwh'], with_benefits)
-        duty = result['duty']  # 0
-        excise_uah = result['excise_eur'] * eur_rate
-        if with_benefits:
-            vat = 0.0
-        else:
-            vat_base = total_uah + excise_uah
-            vat = vat_base * 0.20
     elif vehicle_type == "car_hybrid_petrol":
         result = calculate_hybrid_petrol(total_uah, data['engine_volume'], data['year'])
-        duty = result['duty']
-        excise_uah = result['excise_eur'] * eur_rate
     elif vehicle_type == "car_hybrid_diesel":
         result = calculate_hybrid_diesel(total_uah, data['engine_volume'], data['year'])
-        duty = result['duty']
-        excise_uah = result['excise_eur'] * eur_rate
     elif vehicle_type == "truck_petrol":
         result = calculate_truck(total_uah, data['engine_volume'], data['year'])
-        duty = result['duty']
-        excise_uah = result['excise_eur'] * eur_rate
     elif vehicle_type == "truck_diesel":
         result = calculate_diesel_truck(total_uah, data['engine_volume'], data['year'])
-        duty = result['duty']
-        excise_uah = result['excise_eur'] * eur_rate
     elif vehicle_type == "truck_electric":
         result = calculate_electric_truck(total_uah)
-        duty = result['duty']
-        excise_uah = result['excise_eur'] * eur_rate
     elif vehicle_type == "moto_petrol":
         result = calculate_motorcycle(total_uah, data['engine_volume'])
-        duty = result['duty']
-        excise_uah = result['excise_eur'] * eur_rate
     elif vehicle_type == "moto_electric":
         result = calculate_electric_motorcycle(total_uah)
-        duty = result['duty']
-        excise_uah = result['excise_eur'] * eur_rate
+    else:
+        raise ValueError(f"Unknown vehicle type: {vehicle_type}")
+
+    duty = result['duty']
+    excise_uah = result['excise_eur'] * eur_rate
 
     # VAT calculation
     if vehicle_type != "car_electric_benefits":
@@ -1585,8 +1989,33 @@ async def perform_calculation(message: types.Message, state: FSMContext, date: d
     # Total customs duties (WITHOUT pension fund)
     total_customs = duty + excise_uah + vat
 
-    # Total (with pension fund)
-    total_payments = total_customs + pension
+    return {
+        'cost_uah': cost_uah,
+        'additional_uah': additional_uah,
+        'total_uah': total_uah,
+        'duty': duty,
+        'excise_eur': result.get('excise_eur', 0),
+        'excise_uah': excise_uah,
+        'vat': vat,
+        'pension': pension,
+        'is_electric': is_electric,
+        'total_customs': total_customs,
+        # Total (with pension fund)
+        'total_payments': total_customs + pension,
+    }
+
+
+def format_calculation(data: Dict, calc: Dict, date: datetime, usd_rate: float, eur_rate: float) -> str:
+    """HTML text of the calculation result"""
+    vehicle_type = data['vehicle_type']
+    cost = data['cost']
+    currency = data['currency']
+    additional = data.get('additional', 0)
+    additional_currency = data.get('additional_currency', 'USD')
+    total_uah = calc['total_uah']
+    duty = calc['duty']
+    vat = calc['vat']
+    total_customs = calc['total_customs']
 
     # We get the year and calculate the coefficient for display
     year_info = ""
@@ -1615,9 +2044,9 @@ async def perform_calculation(message: types.Message, state: FSMContext, date: d
 
     # Forming a response
     response = f"📊 <b>Результат розрахунку</b>\n\n"
-    response += f"💰 Вартість: {cost} {currency} = {cost_uah:.2f} грн\n"
+    response += f"💰 Вартість: {cost} {currency} = {calc['cost_uah']:.2f} грн\n"
     if additional > 0:
-        response += f"➕ Дод. витрати: {additional} {additional_currency} = {additional_uah:.2f} грн\n"
+        response += f"➕ Дод. витрати: {additional} {additional_currency} = {calc['additional_uah']:.2f} грн\n"
     response += f"💵 Загальна вартість: {total_uah:.2f} грн\n\n"
 
     if year_info:
@@ -1642,7 +2071,7 @@ async def perform_calculation(message: types.Message, state: FSMContext, date: d
     else:
         response += f"• Мито (10%): {duty:.2f} грн\n"
 
-    response += f"• Акциз: {result.get('excise_eur', 0):.2f} EUR = {excise_uah:.2f} грн\n"
+    response += f"• Акциз: {calc['excise_eur']:.2f} EUR = {calc['excise_uah']:.2f} грн\n"
 
     if vehicle_type == "car_electric_benefits":
         response += f"• ПДВ (0% - пільга): {vat:.2f} грн\n"
@@ -1652,7 +2081,7 @@ async def perform_calculation(message: types.Message, state: FSMContext, date: d
     response += f"\n💵 <b>РАЗОМ митниця: {total_customs:.2f} грн ({total_in_currency:.2f} {currency_symbol})</b>\n"
 
     # Пенсійний фонд
-    if is_electric:
+    if calc['is_electric']:
         response += f"\n• Пенсійний фонд: 0.00 грн (електромобілі не сплачують ✅)\n"
     else:
         # Определяем процент
@@ -1662,34 +2091,51 @@ async def perform_calculation(message: types.Message, state: FSMContext, date: d
             pension_percent = "4%"
         else:
             pension_percent = "5%"
-        response += f"\n• Пенсійний фонд ({pension_percent}): {pension:.2f} грн\n"
+        response += f"\n• Пенсійний фонд ({pension_percent}): {calc['pension']:.2f} грн\n"
 
-    response += f"\n💰 <b>ВСЬОГО з пенсійним: {total_payments:.2f} грн</b>\n"
+    response += f"\n💰 <b>ВСЬОГО з пенсійним: {calc['total_payments']:.2f} грн</b>\n"
     response += f"\n📅 Курс НБУ на {date.strftime('%d.%m.%Y')}:\n"
     response += f"USD: {usd_rate:.2f} грн | EUR: {eur_rate:.2f} грн"
+    return response
+
 
-    await message.answer(response, parse_mode="HTML", reply_markup=get_main_menu())
+async def perform_calculation(message: types.Message, data: Dict, date: datetime, user: types.User,
+                              edit: bool = False):
+    """Calculation of customs duties (edit=True: `message` is the bot's message to edit in place)"""
+    message, edit = await show_progress(message, date, edit)
+
+    # Получение курсов валют
+    usd_rate, eur_rate = await get_nbu_rates(date)
+    if not usd_rate or not eur_rate:
+        await answer_or_edit(message, "❌ Помилка отримання курсу валют", edit)
+        return
+
+    vehicle_type = data['vehicle_type']
+    calc = compute_customs(data, usd_rate, eur_rate)
+    response = format_calculation(data, calc, date, usd_rate, eur_rate)
+
+    await answer_or_edit(message, response, edit)
 
     # Saving to the database and memory
     calc_data = {
-        'user_id': message.from_user.id,
-        'username': message.from_user.username or '',
+        'user_id': user.id,
+        'username': user.username or '',
         'vehicle_type': vehicle_type,
-        'cost': cost,
-        'currency': currency,
-        'additional': additional,
-        'total_uah': total_uah,
-        'duty': duty,
-        'excise': excise_uah,
-        'vat': vat,
-        'pension': pension,
-        'total_payments': total_payments,
+        'cost': data['cost'],
+        'currency': data['currency'],
+        'additional': data.get('additional', 0),
+        'total_uah': calc['total_uah'],
+        'duty': calc['duty'],
+        'excise': calc['excise_uah'],
+        'vat': calc['vat'],
+        'pension': calc['pension'],
+        'total_payments': calc['total_payments'],
         'year': data.get('year'),
         'engine_volume': data.get('engine_volume'),
         'battery_kwh': data.get('battery_kwh'),
         'usd_rate': usd_rate,
         'eur_rate': eur_rate,
-        'total_customs': total_customs,
+        'total_customs': calc['total_customs'],
         'date': datetime.now().strftime('%d.%m.%Y %H:%M')
     }
 
@@ -1698,7 +2144,7 @@ async def perform_calculation(message: types.Message, state: FSMContext, date: d
 
     # Saving to SQLite
     try:
-        with get_db() as conn:
+        with get_db('insert_calculation') as conn:
             cursor = conn.cursor()
             cursor.execute('''
                            INSERT INTO calculations
@@ -1727,6 +2173,196 @@ async def perform_calculation(message: types.Message, state: FSMContext, date: d
     except Exception as e:
         logger.error(f"❌ Помилка збереження у БД: {e}")
 
+
+# Vehicle names accepted in text queries (inline mode): alias -> vehicle_type
+QUERY_VEHICLE_ALIASES = {
+    'petrol': 'car_petrol', 'бензин': 'car_petrol',
+    'diesel': 'car_diesel', 'дизель': 'car_diesel',
+    'electric': 'car_electric_no_benefits', 'ev': 'car_electric_no_benefits', 'електро': 'car_electric_no_benefits',
+    'hybrid': 'car_hybrid_petrol', 'гібрид': 'car_hybrid_petrol',
+    'hybrid_diesel': 'car_hybrid_diesel', 'гібрид_дизель': 'car_hybrid_diesel',
+    'truck': 'truck_diesel', 'вантажівка': 'truck_diesel',
+    'truck_petrol': 'truck_petrol', 'truck_diesel': 'truck_diesel', 'truck_electric': 'truck_electric',
+    'moto': 'moto_petrol', 'мото': 'moto_petrol',
+    'moto_electric': 'moto_electric', 'електромото': 'moto_electric',
+}
+
+# Parameters required by each vehicle type, in input order
+VEHICLE_SPEC_FIELDS = {
+    'car_petrol': ('engine_volume', 'year'),
+    'car_diesel': ('engine_volume', 'year'),
+    'car_electric_no_benefits': ('battery_kwh',),
+    'car_electric_benefits': ('battery_kwh',),
+    'car_hybrid_petrol': ('engine_volume', 'year'),
+    'car_hybrid_diesel': ('engine_volume', 'year'),
+    'truck_petrol': ('engine_volume', 'year'),
+    'truck_diesel': ('engine_volume', 'year'),
+    'truck_electric': (),
+    'moto_petrol': ('engine_volume',),
+    'moto_electric': (),
+}
+
+VEHICLE_LABELS = {
+    'car_petrol': '⛽ Бензин',
+    'car_diesel': '🛢️ Дизель',
+    'car_electric_no_benefits': '⚡ Електро',
+    'car_electric_benefits': '⚡ Електро (пільги)',
+    'car_hybrid_petrol': '🔌 Гібрид (бензин)',
+    'car_hybrid_diesel': '🔌 Гібрид (дизель)',
+    'truck_petrol': '🚛 Вантажний (бензин)',
+    'truck_diesel': '🚛 Вантажний (дизель)',
+    'truck_electric': '🚛 Вантажний (електро)',
+    'moto_petrol': '🏍️ Мотоцикл',
+    'moto_electric': '🏍️ Електромотоцикл',
+}
+
+CURRENCY_ALIASES = {
+    'usd': 'USD', '$': 'USD', 'eur': 'EUR', '€': 'EUR', 'uah': 'UAH', 'грн': 'UAH',
+}
+
+# Rendered inline results: (query, rate date) -> list of articles
+quote_cache: "OrderedDict[Tuple[str, str], List[types.InlineQueryResultArticle]]" = OrderedDict()
+
+
+def parse_positive(value: str) -> float:
+    """A cost, volume or capacity: float() also takes 'nan', 'inf' and negatives, they are rejected"""
+    number = float(value)
+    if not math.isfinite(number) or number <= 0:
+        raise ValueError(f"not a positive number: {value}")
+    return number
+
+
+def parse_vehicle_spec(vehicle_type: str, numbers: List[str]) -> Optional[Dict]:
+    """Engine volume / year / battery for a vehicle type from positional numbers"""
+    fields = VEHICLE_SPEC_FIELDS[vehicle_type]
+    if len(numbers) < len(fields):
+        return None
+
+    spec = {}
+    for field, value in zip(fields, numbers):
+        if field == 'year':
+            year = int(value)
+            if year < 1900 or year > datetime.now().year + 1:
+                return None
+            spec['year'] = year
+        else:
+            spec[field] = parse_positive(value)
+    return spec
+
+
+def parse_quote_query(text: str) -> Optional[Dict]:
+    """Parsing `<type> <cost> [currency] [volume] [year | battery]` into FSM-like data"""
+    tokens = text.lower().replace(',', '.').split()
+    if len(tokens) < 2:
+        return None
+
+    vehicle_type = QUERY_VEHICLE_ALIASES.get(tokens[0], tokens[0])
+    if vehicle_type not in VEHICLE_SPEC_FIELDS:
+        return None
+
+    currency = 'USD'
+    numbers = []
+    for token in tokens[1:]:
+        if token in CURRENCY_ALIASES:
+            currency = CURRENCY_ALIASES[token]
+        else:
+            numbers.append(token)
+
+    try:
+        cost = parse_positive(numbers[0])
+        spec = parse_vehicle_spec(vehicle_type, numbers[1:])
+    except (ValueError, IndexError):
+        return None
+    if spec is None:
+        return None
+
+    return {
+        'vehicle_type': vehicle_type,
+        'cost': cost,
+        'currency': currency,
+        'additional': 0,
+        'additional_currency': 'USD',
+        **spec,
+    }
+
+
+def build_quote_article(data: Dict, date: datetime, usd_rate: float, eur_rate: float) -> types.InlineQueryResultArticle:
+    """Pre-rendered inline article with the full calculation"""
+    calc = compute_customs(data, usd_rate, eur_rate)
+    key = f"{data}|{date:%Y%m%d}"
+    return types.InlineQueryResultArticle(
+        id=hashlib.md5(key.encode()).hexdigest(),
+        title=f"{VEHICLE_LABELS[data['vehicle_type']]}: {data['cost']:g} {data['currency']} → "
+              f"{calc['total_payments']:.0f} грн",
+        description=f"Мито {calc['duty']:.0f} • Акциз {calc['excise_uah']:.0f} • "
+                    f"ПДВ {calc['vat']:.0f} • Пенсійний {calc['pension']:.0f} грн",
+        input_message_content=types.InputTextMessageContent(
+            message_text=format_calculation(data, calc, date, usd_rate, eur_rate),
+            parse_mode="HTML"
+        )
+    )
+
+
+def _seconds_until_midnight() -> int:
+    """Inline results are only valid until the next NBU rate date"""
+    now = datetime.now()
+    midnight = (now + timedelta(days=1)).replace(hour=0, minute=0, second=0, microsecond=0)
+    return max(60, int((midnight - now).total_seconds()))
+
+
+# Inline mode handler: "@bot diesel 12000 USD 2500 2017"
+@dp.inline_query()
+async def inline_quote(inline_query: types.InlineQuery):
+    """Instant quote in any chat without the FSM dialog"""
+    query = " ".join(inline_query.query.lower().split())
+    data = parse_quote_query(query)
+
+    if data is None:
+        help_article = types.InlineQueryResultArticle(
+            id="help",
+            title="Формат: тип вартість валюта об'єм рік",
+            description="diesel 12000 USD 2500 2017 • electric 30000 EUR 75 • moto 8000 USD 600",
+            input_message_content=types.InputTextMessageContent(
+                message_text="🇺🇦 Калькулятор митних платежів: приклад запиту "
+                             "<code>diesel 12000 USD 2500 2017</code>",
+                parse_mode="HTML"
+            )
+        )
+        await inline_query.answer([help_article], cache_time=INLINE_CACHE_TIME, is_personal=False)
+        return
+
+    date = datetime.now()
+    cache_key = (query, date.strftime('%Y%m%d'))
+    results = quote_cache.get(cache_key)
+    cache_requests_total.inc('quote', 'miss' if results is None else 'hit')
+
+    if results is None:
+        try:
+            # Only the wait is bounded: the fetch itself keeps running and fills the rate cache
+            usd_rate, eur_rate = await asyncio.wait_for(asyncio.shield(get_nbu_rates(date)), INLINE_RATE_TIMEOUT)
+        except asyncio.TimeoutError:
+            usd_rate, eur_rate = None, None
+
+        if not usd_rate or not eur_rate:
+            # No cache_time: the next keystroke should retry once the rates are in the cache
+            await inline_query.answer([], cache_time=0, is_personal=False)
+            return
+
+        results = [build_quote_article(data, date, usd_rate, eur_rate)]
+        quote_cache[cache_key] = results
+        if len(quote_cache) > QUOTE_CACHE_SIZE:
+            quote_cache.popitem(last=False)
+    else:
+        quote_cache.move_to_end(cache_key)
+
+    # The answer doesn't depend on the user, so Telegram may serve it to everyone
+    await inline_query.answer(
+        results,
+        cache_time=min(INLINE_CACHE_TIME, _seconds_until_midnight()),
+        is_personal=False
+    )
+
+
 @dp.message(Command("start"))
 async def cmd_start(message: types.Message, state: FSMContext):
     """Processing the /start command"""
@@ -1767,7 +2403,7 @@ async def export_history(message: types.Message):
         return
 
     try:
-        with get_db() as conn:
+        with get_db('export') as conn:
             cursor = conn.cursor()
             cursor.execute('''
                            SELECT *
@@ -1800,6 +2436,500 @@ async def export_history(message: types.Message):
         await message.answer(f"❌ Помилка експорту: {str(e)}")
 
 
+# Comparison mode: years of manufacture shown as rows (offset from the current year)
+COMPARE_YEAR_OFFSETS = (1, 2, 3, 5, 7, 9, 12, 16)
+
+COMPARE_SHORT_LABELS = {
+    'car_petrol': 'Бенз',
+    'car_diesel': 'Диз',
+    'car_electric_no_benefits': 'Ел',
+    'car_electric_benefits': 'ЕлП',
+    'car_hybrid_petrol': 'ГібБ',
+    'car_hybrid_diesel': 'ГібД',
+}
+
+
+def get_comparison_vehicle_types() -> List[str]:
+    """Passenger car types offered in the car type menu"""
+    return [
+        button.callback_data
+        for row in get_car_type_menu().inline_keyboard
+        for button in row
+        if button.callback_data.startswith("car_")
+    ]
+
+
+def parse_comparison_query(text: str) -> Optional[Dict]:
+    """Parsing `<cost> [currency] <engine volume> [battery kWh]`"""
+    tokens = text.lower().replace(',', '.').split()
+    currency = 'USD'
+    numbers = []
+    for token in tokens:
+        if token in CURRENCY_ALIASES:
+            currency = CURRENCY_ALIASES[token]
+        else:
+            numbers.append(token)
+
+    try:
+        values = [parse_positive(n) for n in numbers]
+    except ValueError:
+        return None
+    if len(values) < 2:
+        return None
+
+    return {
+        'cost': values[0],
+        'currency': currency,
+        'engine_volume': values[1],
+        'battery_kwh': values[2] if len(values) > 2 else None,
+    }
+
+
+def compute_comparison_grid(query: Dict, years: List[int], usd_rate: float, eur_rate: float) -> Dict[str, Dict[int, float]]:
+    """Total payments for every car type x year with one set of rates"""
+    grid = {}
+    for vehicle_type in get_comparison_vehicle_types():
+        fields = VEHICLE_SPEC_FIELDS[vehicle_type]
+        if 'battery_kwh' in fields and not query['battery_kwh']:
+            continue
+
+        data = {
+            'vehicle_type': vehicle_type,
+            'cost': query['cost'],
+            'currency': query['currency'],
+            'engine_volume': query['engine_volume'],
+            'battery_kwh': query['battery_kwh'],
+        }
+        if 'year' not in fields:
+            # The result doesn't depend on the year, calculate once for the whole column
+            total = compute_customs(data, usd_rate, eur_rate)['total_payments']
+            grid[vehicle_type] = {year: total for year in years}
+            continue
+
+        grid[vehicle_type] = {
+            year: compute_customs({**data, 'year': year}, usd_rate, eur_rate)['total_payments']
+            for year in years
+        }
+    return grid
+
+
+def format_comparison_table(query: Dict, grid: Dict[str, Dict[int, float]], years: List[int],
+                            date: datetime, usd_rate: float, eur_rate: float) -> str:
+    """Compact monospace table of the comparison grid (thousands of UAH)"""
+    columns = list(grid)
+    header = "Рік " + "".join(f"{COMPARE_SHORT_LABELS[c]:>7}" for c in columns)
+    lines = [header]
+    for year in years:
+        lines.append(f"{year}" + "".join(f"{grid[c][year] / 1000:>7.1f}" for c in columns))
+
+    text = f"📊 <b>Порівняння: {query['cost']:g} {query['currency']}, {query['engine_volume']:g} см³"
+    if query['battery_kwh']:
+        text += f", {query['battery_kwh']:g} кВт·год"
+    text += "</b>\n\nВСЬОГО з пенсійним, тис. грн:\n"
+    text += "<pre>" + "\n".join(lines) + "</pre>\n"
+    text += f"\n📅 Курс НБУ на {date.strftime('%d.%m.%Y')}:\n"
+    text += f"USD: {usd_rate:.2f} грн | EUR: {eur_rate:.2f} грн"
+    return text
+
+
+async def send_comparison(message: types.Message, query: Dict):
+    """One rate lookup and one reply for the whole comparison grid"""
+    date = datetime.now()
+    usd_rate, eur_rate = await get_nbu_rates(date)
+    if not usd_rate or not eur_rate:
+        await message.answer("❌ Помилка отримання курсу валют")
+        return
+
+    years = [date.year - offset for offset in COMPARE_YEAR_OFFSETS]
+    grid = compute_comparison_grid(query, years, usd_rate, eur_rate)
+    await message.answer(
+        format_comparison_table(query, grid, years, date, usd_rate, eur_rate),
+        parse_mode="HTML",
+        reply_markup=get_main_menu()
+    )
+
+
+COMPARE_PROMPT = (
+    "📊 <b>Порівняння типів двигуна та років випуску</b>\n\n"
+    "Введіть вартість, валюту, об'єм двигуна та (необов'язково) ємність батареї для електро:\n"
+    "<code>15000 USD 2000 75</code>"
+)
+
+
+@dp.message(Command("compare"))
+async def cmd_compare(message: types.Message, state: FSMContext, command: CommandObject):
+    """Comparison matrix: /compare 15000 USD 2000 75"""
+    query = parse_comparison_query(command.args or "")
+    if query is None:
+        await state.set_state(CalculationStates.entering_comparison)
+        await message.answer(COMPARE_PROMPT, parse_mode="HTML")
+        return
+
+    await state.clear()
+    await send_comparison(message, query)
+
+
+@dp.message(CalculationStates.entering_comparison)
+async def process_comparison(message: types.Message, state: FSMContext):
+    """Processing comparison input"""
+    query = parse_comparison_query(message.text or "")
+    if query is None:
+        await message.answer("❌ Введіть, наприклад: <code>15000 USD 2000 75</code>", parse_mode="HTML")
+        return
+
+    await state.clear()
+    await send_comparison(message, query)
+
+
+def solve_max_total_uah(data: Dict, budget_uah: float, usd_rate: float, eur_rate: float) -> Optional[float]:
+    """
+    Maximum total value (price + additional, UAH) that fits into an all-in budget
+
+    All-in = value + customs + pension. Duty, excise and VAT are linear in the value
+    (customs = a * value + b) and the pension fund rate is constant inside each tier,
+    so each tier is solved in closed form: value = (budget - b) / (1 + a + rate).
+    """
+    probe = 1_000_000.0
+    base = {**data, 'currency': 'UAH', 'additional': 0}
+    at_zero = compute_customs({**base, 'cost': 0.0}, usd_rate, eur_rate)
+    at_probe = compute_customs({**base, 'cost': probe}, usd_rate, eur_rate)
+
+    b = at_zero['total_customs']
+    a = (at_probe['total_customs'] - b) / probe
+    if budget_uah <= b:
+        return None
+
+    if at_probe['pension'] == 0:
+        tiers = [(0.0, float('inf'), 0.0)]
+    else:
+        tiers = []
+        lower_bound = 0.0
+        for upper_bound, rate in PENSION_TIERS:
+            tiers.append((lower_bound, upper_bound, rate))
+            lower_bound = upper_bound
+
+    # All-in cost grows with the value, so the highest reachable tier gives the maximum.
+    # Pension jumps at tier bounds: if the budget falls into a gap, stay just below the bound.
+    for lower_bound, upper_bound, rate in reversed(tiers):
+        value = (budget_uah - b) / (1 + a + rate)
+        if value >= lower_bound:
+            return min(value, upper_bound - 0.01)
+    return None
+
+
+def parse_budget_query(text: str) -> Optional[Dict]:
+    """Parsing `<budget UAH> <type> [volume] [year | battery]`"""
+    tokens = text.lower().replace(',', '.').split()
+    if len(tokens) < 2:
+        return None
+
+    vehicle_type = QUERY_VEHICLE_ALIASES.get(tokens[1], tokens[1])
+    if vehicle_type not in VEHICLE_SPEC_FIELDS:
+        return None
+
+    try:
+        budget = parse_positive(tokens[0])
+        spec = parse_vehicle_spec(vehicle_type, tokens[2:])
+    except ValueError:
+        return None
+    if spec is None:
+        return None
+
+    return {'budget': budget, 'vehicle_type': vehicle_type, **spec}
+
+
+@dp.message(Command("budget"))
+async def cmd_budget(message: types.Message, command: CommandObject):
+    """Maximum purchase price for an all-in budget: /budget 600000 diesel 2000 2017"""
+    query = parse_budget_query(command.args or "")
+    if query is None:
+        await message.answer(
+            "💰 <b>Максимальна вартість авто для бюджету</b>\n\n"
+            "Вкажіть загальний бюджет у грн (авто + митниця + пенсійний), тип і параметри:\n"
+            "<code>/budget 600000 diesel 2000 2017</code>\n"
+            "<code>/budget 900000 electric 75</code>\n"
+            "<code>/budget 300000 moto 600</code>",
+            parse_mode="HTML"
+        )
+        return
+
+    date = datetime.now()
+    usd_rate, eur_rate = await get_nbu_rates(date)
+    if not usd_rate or not eur_rate:
+        await message.answer("❌ Помилка отримання курсу валют")
+        return
+
+    budget = query.pop('budget')
+    max_uah = solve_max_total_uah(query, budget, usd_rate, eur_rate)
+    if max_uah is None:
+        await message.answer(f"❌ Бюджету {budget:.0f} грн не вистачає навіть на акциз для цього ТЗ")
+        return
+
+    # Rounded down so that the quoted price always fits into the budget
+    max_usd = int(max_uah / usd_rate * 100) / 100
+    data = {**query, 'cost': max_usd, 'currency': 'USD', 'additional': 0, 'additional_currency': 'USD'}
+    calc = compute_customs(data, usd_rate, eur_rate)
+
+    response = f"💰 <b>Бюджет {budget:.2f} грн — {VEHICLE_LABELS[query['vehicle_type']]}</b>\n\n"
+    response += f"Максимальна вартість авто:\n"
+    response += f"🇺🇸 {max_usd:.2f} USD\n"
+    response += f"🇪🇺 {max_uah / eur_rate:.2f} EUR\n"
+    response += f"🇺🇦 {max_uah:.2f} грн\n\n"
+    response += f"Авто + митниця + пенсійний: {calc['total_uah'] + calc['total_payments']:.2f} грн\n\n"
+    response += format_calculation(data, calc, date, usd_rate, eur_rate)
+    await message.answer(response, parse_mode="HTML")
+
+
+SWEEP_MAX_DAYS = 365
+
+# Last sweep of each user, for the "📈 Графік" button: user_id -> (data, sweep)
+last_sweeps: "OrderedDict[int, Tuple[Dict, List[Tuple[str, float]]]]" = OrderedDict()
+
+
+def compute_rate_sweep(data: Dict, usd_rates: Dict[str, float], eur_rates: Dict[str, float]) -> List[Tuple[str, float]]:
+    """Total payments for every day that has both rates: [(YYYYMMDD, total_payments)]"""
+    return [
+        (day, compute_customs(data, usd_rates[day], eur_rates[day])['total_payments'])
+        for day in sorted(usd_rates.keys() & eur_rates.keys())
+    ]
+
+
+def format_rate_sweep(data: Dict, sweep: List[Tuple[str, float]]) -> str:
+    """Summary of a rate sweep: current, min, max and the best day"""
+    def day_label(day: str) -> str:
+        return datetime.strptime(day, '%Y%m%d').strftime('%d.%m.%Y')
+
+    best_day, best = min(sweep, key=lambda item: item[1])
+    worst_day, worst = max(sweep, key=lambda item: item[1])
+    current_day, current = sweep[-1]
+
+    response = f"📈 <b>{VEHICLE_LABELS[data['vehicle_type']]}: {data['cost']:g} {data['currency']}</b>\n"
+    response += f"Курси НБУ за {len(sweep)} дн. ({day_label(sweep[0][0])} — {day_label(current_day)})\n\n"
+    response += f"💰 Зараз ({day_label(current_day)}): {current:.2f} грн\n"
+    response += f"⬇️ Мінімум: {best:.2f} грн ({day_label(best_day)})\n"
+    response += f"⬆️ Максимум: {worst:.2f} грн ({day_label(worst_day)})\n"
+    response += f"↕️ Різниця: {worst - best:.2f} грн\n\n"
+    if best_day == current_day:
+        response += "✅ Сьогодні найвигідніший день за період"
+    else:
+        response += f"🏆 Найвигідніший день: {day_label(best_day)} (на {current - best:.2f} грн дешевше, ніж зараз)"
+    return response
+
+
+@dp.message(Command("sweep"))
+async def cmd_sweep(message: types.Message, command: CommandObject):
+    """Customs cost across the last N days: /sweep 30 diesel 12000 USD 2500 2017"""
+    args = (command.args or "").split(maxsplit=1)
+    data = parse_quote_query(args[1]) if len(args) == 2 else None
+    if data is None or not args[0].isdigit() or not 1 <= int(args[0]) <= SWEEP_MAX_DAYS:
+        await message.answer(
+            "📈 <b>Митні платежі за курсами НБУ за останні N днів</b>\n\n"
+            f"Вкажіть кількість днів (до {SWEEP_MAX_DAYS}) і авто у форматі інлайн-запиту:\n"
+            "<code>/sweep 30 diesel 12000 USD 2500 2017</code>",
+            parse_mode="HTML"
+        )
+        return
+
+    end = datetime.now()
+    start = end - timedelta(days=int(args[0]) - 1)
+    usd_rates, eur_rates = await asyncio.gather(
+        get_nbu_rate_range("USD", start, end),
+        get_nbu_rate_range("EUR", start, end)
+    )
+    sweep = compute_rate_sweep(data, usd_rates, eur_rates)
+    if not sweep:
+        await message.answer("❌ Помилка отримання курсу валют")
+        return
+
+    last_sweeps[message.from_user.id] = (data, sweep)
+    last_sweeps.move_to_end(message.from_user.id)
+    if len(last_sweeps) > SWEEP_CACHE_SIZE:
+        last_sweeps.popitem(last=False)
+
+    keyboard = InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="📈 Графік", callback_data="chart_sweep")]
+    ])
+    await message.answer(format_rate_sweep(data, sweep), parse_mode="HTML", reply_markup=keyboard)
+
+
+# Rendered charts: (series, start, end) -> {'png': bytes, 'file_id': Telegram file_id once uploaded}
+chart_cache: "OrderedDict[Tuple[str, str, str], Dict]" = OrderedDict()
+_chart_pool: Optional[Executor] = None
+
+
+def get_chart_pool() -> Executor:
+    """Process pool for chart rendering, so matplotlib never blocks the event loop"""
+    global _chart_pool
+    if _chart_pool is None:
+        # multiprocessing is only imported once a chart is needed
+        from concurrent.futures import ProcessPoolExecutor
+        _chart_pool = ProcessPoolExecutor(max_workers=CHART_WORKERS)
+        # Worker processes must not outlive the bot, even if the shutdown hook never runs
+        atexit.register(shutdown_chart_pool)
+    return _chart_pool
+
+
+def shutdown_chart_pool():
+    """Stopping chart worker processes"""
+    global _chart_pool
+    if _chart_pool is not None:
+        _chart_pool.shutdown(wait=False, cancel_futures=True)
+        _chart_pool = None
+
+
+async def get_chart(key: Tuple[str, str, str], title: str, labels: List[str],
+                    series: Dict[str, List[float]], ylabel: str) -> Dict:
+    """Chart from the cache or rendered in the process pool"""
+    entry = chart_cache.get(key)
+    cache_requests_total.inc('chart', 'miss' if entry is None else 'hit')
+    if entry is not None:
+        chart_cache.move_to_end(key)
+        return entry
+
+    loop = asyncio.get_running_loop()
+    with span("chart:render"):
+        png = await loop.run_in_executor(get_chart_pool(), render_line_chart, title, labels, series, ylabel)
+    entry = {'png': png, 'file_id': None}
+    chart_cache[key] = entry
+    if len(chart_cache) > CHART_CACHE_SIZE:
+        chart_cache.popitem(last=False)
+    return entry
+
+
+async def send_chart(message: types.Message, key: Tuple[str, str, str], title: str, labels: List[str],
+                     series: Dict[str, List[float]], ylabel: str):
+    """Sending a chart, re-using the Telegram file_id after the first upload"""
+    try:
+        entry = await get_chart(key, title, labels, series, ylabel)
+    except Exception as e:
+        logger.error(f"Помилка побудови графіка: {e}")
+        await message.answer("❌ Не вдалося побудувати графік")
+        return
+
+    if entry['file_id']:
+        await message.answer_photo(entry['file_id'], caption=title)
+    else:
+        sent = await message.answer_photo(
+            types.BufferedInputFile(entry['png'], filename="chart.png"),
+            caption=title
+        )
+        entry['file_id'] = sent.photo[-1].file_id
+
+
+async def build_rate_chart(days: int) -> Optional[Tuple[Tuple[str, str, str], str, List[str], Dict[str, List[float]]]]:
+    """Key, title, labels and series of the USD/EUR history chart"""
+    end = datetime.now()
+    start = end - timedelta(days=days - 1)
+    usd_rates, eur_rates = await asyncio.gather(
+        get_nbu_rate_range("USD", start, end),
+        get_nbu_rate_range("EUR", start, end)
+    )
+    days_with_rates = sorted(usd_rates.keys() & eur_rates.keys())
+    if not days_with_rates:
+        return None
+
+    key = ("rates", days_with_rates[0], days_with_rates[-1])
+    title = f"Курс НБУ USD/EUR за {days} дн."
+    labels = [f"{day[6:8]}.{day[4:6]}" for day in days_with_rates]
+    series = {
+        "USD": [usd_rates[day] for day in days_with_rates],
+        "EUR": [eur_rates[day] for day in days_with_rates],
+    }
+    return key, title, labels, series
+
+
+@dp.message(Command("chart"))
+async def cmd_chart(message: types.Message, command: CommandObject):
+    """USD/EUR rate history chart: /chart 90"""
+    args = (command.args or "").strip()
+    days = int(args) if args.isdigit() else POPULAR_CHART_DAYS
+    if not 2 <= days <= SWEEP_MAX_DAYS:
+        await message.answer(f"❌ Вкажіть кількість днів від 2 до {SWEEP_MAX_DAYS}")
+        return
+
+    chart = await build_rate_chart(days)
+    if chart is None:
+        await message.answer("❌ Помилка отримання курсу валют")
+        return
+
+    key, title, labels, series = chart
+    await send_chart(message, key, title, labels, series, "грн")
+
+
+@dp.callback_query(F.data == "chart_sweep")
+async def process_sweep_chart(callback: types.CallbackQuery):
+    """Chart of the user's last rate sweep"""
+    await callback.answer()
+    last = last_sweeps.get(callback.from_user.id)
+    if last is None:
+        await callback.message.answer("❌ Спочатку виконайте /sweep")
+        return
+
+    data, sweep = last
+    query = f"{data['vehicle_type']} {data['cost']:g} {data['currency']} " \
+            f"{data.get('engine_volume')} {data.get('year')} {data.get('battery_kwh')}"
+    key = (f"sweep:{query}", sweep[0][0], sweep[-1][0])
+    title = f"{data['cost']:g} {data['currency']}: митниця + пенсійний за курсами НБУ"
+    labels = [f"{day[6:8]}.{day[4:6]}" for day, _ in sweep]
+    await send_chart(callback.message, key, title, labels, {"грн": [total for _, total in sweep]}, "грн")
+
+
+async def warm_popular_charts():
+    """Pre-rendering the most requested charts"""
+    chart = await build_rate_chart(POPULAR_CHART_DAYS)
+    if chart is not None:
+        key, title, labels, series = chart
+        await get_chart(key, title, labels, series, "грн")
+        logger.info(f"📈 Графік курсів за {POPULAR_CHART_DAYS} днів підготовлено")
+
+
+async def chart_warmup_loop():
+    """Re-rendering popular charts once per day, shortly after the NBU date changes"""
+    while True:
+        try:
+            await warm_popular_charts()
+        except Exception as e:
+            logger.error(f"Помилка підготовки графіків: {e}")
+        now = datetime.now()
+        next_run = (now + timedelta(days=1)).replace(hour=0, minute=5, second=0, microsecond=0)
+        await asyncio.sleep((next_run - now).total_seconds())
+
+
+# Daily NBU rate digest subscription
+@dp.message(Command("subscribe"))
+async def cmd_subscribe(message: types.Message):
+    """Subscribing the chat to the morning rate digest"""
+    try:
+        with get_db('subscription') as conn:
+            conn.execute('''
+                         INSERT INTO subscriptions (chat_id, user_id, active)
+                         VALUES (?, ?, 1)
+                         ON CONFLICT(chat_id) DO UPDATE SET active = 1
+                         ''', (message.chat.id, message.from_user.id))
+            conn.commit()
+    except Exception as e:
+        logger.error(f"❌ Помилка підписки: {e}")
+        await message.answer("❌ Не вдалося оформити підписку")
+        return
+
+    await message.answer(
+        "🔔 Ви підписалися на щоденний курс НБУ (USD/EUR) та сповіщення, "
+        "коли опубліковано курс на завтра.\n\nВідписатися: /unsubscribe"
+    )
+
+
+@dp.message(Command("unsubscribe"))
+async def cmd_unsubscribe(message: types.Message):
+    """Unsubscribing the chat from the rate digest"""
+    try:
+        with get_db('subscription') as conn:
+            conn.execute('UPDATE subscriptions SET active = 0 WHERE chat_id = ?', (message.chat.id,))
+            conn.commit()
+    except Exception as e:
+        logger.error(f"❌ Помилка відписки: {e}")
+    await message.answer("🔕 Ви відписалися від розсилки курсу")
+
+
 # Callback handler "Back"
 @dp.callback_query(F.data == "back_main")
 async def back_to_main(callback: types.CallbackQuery, state: FSMContext):
@@ -0,0 +1,289 @@
+import asyncio
+import functools
+import json
+import logging
+import sqlite3
+import sys
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import astuple
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StorageKey
+from aiogram.fsm.storage.memory import MemoryStorage
+
+logger = logging.getLogger(__name__)
+
+
+def storage_key_id(key: StorageKey) -> str:
+    """Stable string id of a storage key (JSON list of its fields)"""
+    return json.dumps(astuple(key))
+
+
+def approx_size(value: Any) -> int:
+    """Approximate deep size in bytes of FSM data (dicts, lists and scalars)"""
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        size += sum(approx_size(k) + approx_size(v) for k, v in value.items())
+    elif isinstance(value, (list, tuple, set)):
+        size += sum(approx_size(item) for item in value)
+    return size
+
+
+class TTLMemoryStorage(MemoryStorage):
+    """
+    MemoryStorage that forgets abandoned dialogs
+
+    Every access refreshes the session's last-touch time. Sessions idle for longer
+    than `ttl` seconds are evicted (oldest first) and the total number of sessions
+    is capped at `max_sessions`, so memory stays bounded whatever the traffic was.
+    """
+
+    def __init__(self, ttl: int = 86400, max_sessions: int = 100000):
+        super().__init__()
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self.evicted = 0
+        # Sessions ordered by last touch: key -> monotonic time
+        self._touched: "OrderedDict[StorageKey, float]" = OrderedDict()
+
+    def _evict(self, now: float):
+        """Dropping idle sessions from the front of the touch order"""
+        while self._touched:
+            key, touched_at = next(iter(self._touched.items()))
+            if now - touched_at <= self.ttl and len(self._touched) <= self.max_sessions:
+                break
+            self._touched.popitem(last=False)
+            self.storage.pop(key, None)
+            self.evicted += 1
+
+    def _touch(self, key: StorageKey):
+        """Refreshing the session, or forgetting it if it is empty (state cleared)"""
+        record = self.storage.get(key)
+        if record is None or (record.state is None and not record.data):
+            self.storage.pop(key, None)
+            self._touched.pop(key, None)
+            return
+        self._touched[key] = time.monotonic()
+        self._touched.move_to_end(key)
+
+    async def set_state(self, key: StorageKey, state: Optional[Any] = None) -> None:
+        self._evict(time.monotonic())
+        await super().set_state(key, state)
+        self._touch(key)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        self._evict(time.monotonic())
+        state = await super().get_state(key)
+        self._touch(key)
+        return state
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        self._evict(time.monotonic())
+        await super().set_data(key, data)
+        self._touch(key)
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        self._evict(time.monotonic())
+        data = await super().get_data(key)
+        self._touch(key)
+        return data
+
+    async def get_value(self, storage_key: StorageKey, dict_key: str, default: Optional[Any] = None) -> Optional[Any]:
+        return (await self.get_data(storage_key)).get(dict_key, default)
+
+    async def session_count(self) -> int:
+        """Number of live dialogs"""
+        self._evict(time.monotonic())
+        return len(self.storage)
+
+    async def approx_bytes(self) -> int:
+        """Approximate memory used by live dialogs"""
+        return sum(
+            approx_size(key) + approx_size(record.state) + approx_size(record.data)
+            for key, record in self.storage.items()
+        )
+
+    def dump(self) -> List[list]:
+        """Live dialogs as JSON-friendly [key fields, state, data, idle seconds], oldest first"""
+        now = time.monotonic()
+        self._evict(now)
+        return [
+            [list(astuple(key)), self.storage[key].state, self.storage[key].data, round(now - touched_at, 3)]
+            for key, touched_at in self._touched.items()
+        ]
+
+    def restore(self, entries: List[list], elapsed: float = 0.0) -> int:
+        """
+        Loading dialogs saved by dump(), returns how many are still live
+
+        `elapsed` is the time since the dump: it counts towards the idle time, so
+        restored sessions expire when they would have in the old process.
+        """
+        now = time.monotonic()
+        for fields, state, data, idle in entries:
+            key = StorageKey(*fields)
+            if key in self._touched:
+                continue
+            record = self.storage[key]
+            record.state, record.data = state, data
+            self._touched[key] = now - idle - elapsed
+        # Keep the touch order sorted after merging with sessions created meanwhile
+        self._touched = OrderedDict(sorted(self._touched.items(), key=lambda item: item[1]))
+        self._evict(now)
+        return len(self.storage)
+
+
+class SQLiteStorage(BaseStorage):
+    """
+    FSM storage in a local SQLite database (WAL mode)
+
+    Several uvicorn workers can share one database file. Each process keeps a small
+    write-through cache, which is dropped as soon as another connection commits
+    (PRAGMA data_version). Dialogs untouched for `ttl` seconds are expired.
+
+    All database work runs in one dedicated thread, so waiting for another worker's
+    lock never blocks the event loop, and the read-modify-write of set_state/set_data
+    is one IMMEDIATE transaction, so concurrent workers cannot lose each other's writes.
+    """
+
+    def __init__(self, path: str = 'fsm.db', ttl: int = 86400, cache_size: int = 1024,
+                 purge_interval: int = 300):
+        self.ttl = ttl
+        self.cache_size = cache_size
+        self.purge_interval = purge_interval
+
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='fsm-sqlite')
+        self._conn = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute('PRAGMA busy_timeout=5000')
+        self._conn.execute('''
+                           CREATE TABLE IF NOT EXISTS fsm_sessions
+                           (
+                               key        TEXT PRIMARY KEY,
+                               state      TEXT,
+                               data       TEXT NOT NULL DEFAULT '{}',
+                               updated_at REAL NOT NULL
+                           )
+                           ''')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS idx_fsm_updated_at ON fsm_sessions(updated_at)')
+
+        # key id -> (state, data, updated_at)
+        self._cache: "OrderedDict[str, Tuple[Optional[str], Dict[str, Any], float]]" = OrderedDict()
+        self._data_version = self._read_data_version()
+        self._last_purge = time.time()
+
+    def _read_data_version(self) -> int:
+        return self._conn.execute('PRAGMA data_version').fetchone()[0]
+
+    def _sync_cache(self):
+        """Dropping the cache if another worker has written to the database"""
+        version = self._read_data_version()
+        if version != self._data_version:
+            self._cache.clear()
+            self._data_version = version
+
+    def _cache_put(self, key_id: str, entry: Tuple[Optional[str], Dict[str, Any], float]):
+        self._cache[key_id] = entry
+        self._cache.move_to_end(key_id)
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    def _load(self, key: StorageKey) -> Tuple[Optional[str], Dict[str, Any], float]:
+        """Session from the cache or the database (expired sessions are empty)"""
+        key_id = storage_key_id(key)
+        self._sync_cache()
+
+        entry = self._cache.get(key_id)
+        if entry is None:
+            row = self._conn.execute(
+                'SELECT state, data, updated_at FROM fsm_sessions WHERE key = ?', (key_id,)
+            ).fetchone()
+            entry = (row[0], json.loads(row[1]), row[2]) if row else (None, {}, 0.0)
+            self._cache_put(key_id, entry)
+
+        if entry[2] and time.time() - entry[2] > self.ttl:
+            return None, {}, 0.0
+        return entry
+
+    def _save(self, key: StorageKey, state: Optional[str], data: Dict[str, Any]):
+        """Write-through: database first, then the local cache"""
+        key_id = storage_key_id(key)
+        now = time.time()
+
+        if state is None and not data:
+            self._conn.execute('DELETE FROM fsm_sessions WHERE key = ?', (key_id,))
+            self._cache_put(key_id, (None, {}, 0.0))
+        else:
+            self._conn.execute('''
+                               INSERT INTO fsm_sessions (key, state, data, updated_at)
+                               VALUES (?, ?, ?, ?)
+                               ON CONFLICT(key) DO UPDATE SET state      = excluded.state,
+                                                              data       = excluded.data,
+                                                              updated_at = excluded.updated_at
+                               ''', (key_id, state, json.dumps(data, ensure_ascii=False), now))
+            self._cache_put(key_id, (state, data, now))
+
+        self._maybe_purge(now)
+
+    def _maybe_purge(self, now: float):
+        """Deleting abandoned dialogs from time to time"""
+        if now - self._last_purge < self.purge_interval:
+            return
+        self._last_purge = now
+        deleted = self._conn.execute(
+            'DELETE FROM fsm_sessions WHERE updated_at < ?', (now - self.ttl,)
+        ).rowcount
+        if deleted:
+            logger.info(f"🧹 Видалено {deleted} неактивних FSM-сесій")
+
+    def _update(self, key: StorageKey, state: Any = None, data: Optional[Dict[str, Any]] = None,
+                keep_state: bool = False):
+        """Replacing the state or the data of a session atomically (runs in the storage thread)"""
+        self._conn.execute('BEGIN IMMEDIATE')
+        try:
+            current_state, current_data, _ = self._load(key)
+            self._save(key, current_state if keep_state else state, current_data if data is None else data)
+            self._conn.execute('COMMIT')
+        except BaseException:
+            self._conn.execute('ROLLBACK')
+            # The cache may hold the rolled back entry
+            self._cache.pop(storage_key_id(key), None)
+            raise
+
+    def _run(self, func: Callable, *args) -> Awaitable:
+        return asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    def _scalar(self, query: str, *params) -> int:
+        return self._conn.execute(query, params).fetchone()[0]
+
+    async def session_count(self) -> int:
+        """Number of live (not expired) dialogs in the database"""
+        return await self._run(self._scalar, 'SELECT COUNT(*) FROM fsm_sessions WHERE updated_at >= ?',
+                               time.time() - self.ttl)
+
+    async def approx_bytes(self) -> int:
+        """Approximate size of stored dialogs"""
+        return await self._run(
+            self._scalar,
+            'SELECT COALESCE(SUM(LENGTH(key) + LENGTH(data) + COALESCE(LENGTH(state), 0)), 0) FROM fsm_sessions'
+        )
+
+    async def set_state(self, key: StorageKey, state: Optional[Any] = None) -> None:
+        await self._run(self._update, key, state.state if isinstance(state, State) else state)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        return (await self._run(self._load, key))[0]
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        await self._run(functools.partial(self._update, key, data=dict(data), keep_state=True))
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        return dict((await self._run(self._load, key))[1])
+
+    async def close(self) -> None:
+        await self._run(self._conn.close)
+        self._executor.shutdown()
@@ -0,0 +1,103 @@
+import asyncio
+import logging
+import sys
+import threading
+import time
+import traceback
+from typing import Dict, Optional
+
+from metrics import loop_lag_seconds, loop_stalls_total
+
+logger = logging.getLogger(__name__)
+
+
+class LoopLagMonitor:
+    """
+    Event loop responsiveness
+
+    A heartbeat task sleeps `interval` seconds and measures how late it wakes up:
+    that delay is how long other callbacks held the loop. With `stall_threshold`
+    a watchdog thread also checks the heartbeat; when the loop has not beaten for
+    that long, the stack of the loop thread (the code that is blocking it right
+    now) is logged once per stall.
+    """
+
+    def __init__(self, interval: float = 0.5, lag_threshold: float = 0.1, stall_threshold: float = 1.0):
+        self.interval = interval
+        self.lag_threshold = lag_threshold
+        self.stall_threshold = stall_threshold
+
+        self._task: Optional[asyncio.Task] = None
+        self._watchdog: Optional[threading.Thread] = None
+        self._stopped = threading.Event()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._loop_thread_id: Optional[int] = None
+        self._last_beat = time.monotonic()
+
+        # Statistics
+        self.lag_last = 0.0
+        self.lag_max = 0.0
+        self.lagged = 0
+        self.stalls = 0
+
+    def start(self):
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread_id = threading.get_ident()
+        self._last_beat = time.monotonic()
+        self._task = asyncio.create_task(self._heartbeat())
+        if self.stall_threshold:
+            self._watchdog = threading.Thread(target=self._watch, name='loop-watchdog', daemon=True)
+            self._watchdog.start()
+
+    async def stop(self):
+        self._stopped.set()
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+    async def _heartbeat(self):
+        while True:
+            expected = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            self._last_beat = now
+
+            lag = max(0.0, now - expected)
+            self.lag_last = lag
+            self.lag_max = max(self.lag_max, lag)
+            loop_lag_seconds.observe(lag)
+            if lag >= self.lag_threshold:
+                self.lagged += 1
+                logger.warning(f"⚠️ Цикл подій заблоковано на {lag * 1000:.0f} мс")
+
+    def _watch(self):
+        """Watchdog thread: the stack of the loop thread while it is stuck"""
+        reported_beat = None
+        check_every = min(self.interval, self.stall_threshold / 2)
+        while not self._stopped.wait(check_every):
+            beat = self._last_beat
+            stalled_for = time.monotonic() - beat - self.interval
+            if stalled_for < self.stall_threshold or beat == reported_beat:
+                continue
+
+            reported_beat = beat
+            # Counters are only updated on the loop thread (runs once the loop is free again)
+            self._loop.call_soon_threadsafe(self._count_stall)
+            frame = sys._current_frames().get(self._loop_thread_id)
+            stack = ''.join(traceback.format_stack(frame)) if frame is not None else 'стек недоступний'
+            logger.warning(f"🧊 Цикл подій не відповідає {stalled_for:.1f} с, блокує:\n{stack}")
+
+    def _count_stall(self):
+        self.stalls += 1
+        loop_stalls_total.inc()
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            'lag_last': round(self.lag_last, 4),
+            'lag_max': round(self.lag_max, 4),
+            'lagged': self.lagged,
+            'stalls': self.stalls,
+        }
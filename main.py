@@ -1,26 +1,343 @@
 import os
 import asyncio
+import hashlib
+import hmac
+import json
+import logging
+import signal
+import threading
+import time
 from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, PlainTextResponse
+from pydantic import ValidationError
 from aiogram.types import Update
-from customs_calculator_bot import dp, bot
+from collections import deque
+from datetime import datetime
+from typing import Deque, Dict, List
+from customs_calculator_bot import (SNAPSHOT_VERSION, dp, bot, chart_warmup_loop, close_http_session, dump_warm_state,
+                                   get_nbu_rates, init_db, restore_warm_state, send_scheduler, shutdown_chart_pool,
+                                   storage, throttling, tracing)
+from broadcast import broadcast_loop
+import metrics
+from loop_monitor import LoopLagMonitor
+from update_dedupe import UpdateDeduplicator
+from update_queue import UpdateQueue
+from snapshot import claim_snapshots, read_snapshot, worker_snapshot_path, write_snapshot
+from update_recorder import UpdateRecorder
+
+# orjson decodes update bodies several times faster, if it is installed
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    json_loads = json.loads
+
+# Webhook processing: queue size and number of concurrent workers
+UPDATE_QUEUE_SIZE = int(os.getenv('UPDATE_QUEUE_SIZE', '1000'))
+UPDATE_WORKERS = int(os.getenv('UPDATE_WORKERS', '8'))
+# Repeated presses of the same button within this window (seconds) are ignored
+DUPLICATE_CALLBACK_WINDOW = float(os.getenv('DUPLICATE_CALLBACK_WINDOW', '2'))
+# Redelivered updates: size of the update_id window and optional SQLite file shared by workers
+UPDATE_DEDUPE_SIZE = int(os.getenv('UPDATE_DEDUPE_SIZE', '10000'))
+UPDATE_DEDUPE_DB = os.getenv('UPDATE_DEDUPE_DB')
+# Event loop monitor: heartbeat interval, lag worth a warning, stall that dumps the blocking stack (0 = off)
+LOOP_LAG_INTERVAL = float(os.getenv('LOOP_LAG_INTERVAL', '0.5'))
+LOOP_LAG_THRESHOLD = float(os.getenv('LOOP_LAG_THRESHOLD', '0.1'))
+LOOP_STALL_SECONDS = float(os.getenv('LOOP_STALL_SECONDS', '1'))
+# Opt-in recording of anonymized incoming updates for load testing (replay with benchmarks/replay_updates.py)
+RECORD_UPDATES_PATH = os.getenv('RECORD_UPDATES_PATH')
+RECORD_SALT = os.getenv('RECORD_SALT')
+# Secret token Telegram sends in the X-Telegram-Bot-Api-Secret-Token header
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET')
+# Bearer token Prometheus has to send to /metrics (empty = endpoint disabled)
+METRICS_TOKEN = os.getenv('METRICS_TOKEN')
+# CPU-heavy warm-ups (chart rendering) and broadcasts start this many seconds after boot
+STARTUP_WARMUP_DELAY = float(os.getenv('STARTUP_WARMUP_DELAY', '30'))
+# Warm-start snapshots of caches and dialogs, written on shutdown and loaded on startup (empty = off).
+# Each worker writes SNAPSHOT_PATH.<pid>; on startup the workers share out whatever files they find
+SNAPSHOT_PATH = os.getenv('SNAPSHOT_PATH', 'warm_state.json.gz')
+# On shutdown, seconds to wait for queued and in-flight updates before the workers are stopped
+SHUTDOWN_DRAIN_TIMEOUT = float(os.getenv('SHUTDOWN_DRAIN_TIMEOUT', '20'))
+
+logger = logging.getLogger(__name__)
+
+# Update kinds that have handlers; everything else is neither requested nor parsed
+ALLOWED_UPDATES = dp.resolve_used_update_types()
 
 app = FastAPI()
+update_queue = UpdateQueue(
+    lambda update: dp.feed_update(bot, update),
+    maxsize=UPDATE_QUEUE_SIZE,
+    workers=UPDATE_WORKERS,
+    duplicate_window=DUPLICATE_CALLBACK_WINDOW,
+    # The dropped press still has to be answered, or its button keeps spinning
+    on_duplicate=lambda update: bot.answer_callback_query(update.callback_query.id)
+)
+update_dedupe = UpdateDeduplicator(UPDATE_DEDUPE_SIZE, UPDATE_DEDUPE_DB)
+update_recorder = UpdateRecorder(RECORD_UPDATES_PATH, RECORD_SALT) if RECORD_UPDATES_PATH else None
+loop_monitor = LoopLagMonitor(LOOP_LAG_INTERVAL, LOOP_LAG_THRESHOLD, LOOP_STALL_SECONDS)
+# Startup and periodic tasks (kept referenced so they are not garbage collected)
+background_tasks: List[asyncio.Task] = []
+# Handed-over updates that did not fit into the queue at startup, fed to it as it frees up
+handover_backlog: Deque[Update] = deque()
+# Cleared by SIGTERM/SIGINT (see stop_accepting_on_signal): new webhook requests are refused so
+# Telegram redelivers them, while uvicorn is still finishing open connections
+accepting_updates = True
 
 @app.get("/")
 async def health_check():
-    return {"status": "ok"}
+    return {
+        "status": "ok" if accepting_updates else "stopping",
+        "queue": update_queue.stats(),
+        "dedupe": update_dedupe.stats(),
+        "sends": send_scheduler.stats(),
+        "loop": loop_monitor.stats()
+    }
+
+@app.get("/metrics")
+async def prometheus_metrics(request: Request):
+    # Internal counters: only served with METRICS_TOKEN as a bearer token
+    if not METRICS_TOKEN:
+        return JSONResponse(status_code=404, content={"ok": False})
+    authorization = request.headers.get("Authorization", "")
+    if not hmac.compare_digest(authorization.encode(), f"Bearer {METRICS_TOKEN}".encode()):
+        return JSONResponse(status_code=403, content={"ok": False})
+    # Queue depths and other counters are read at scrape time
+    gauges = {
+        "update_queue": update_queue.stats(),
+        "dedupe": update_dedupe.stats(),
+        "sends": send_scheduler.stats(),
+        "throttling": throttling.stats(),
+        "tracing": tracing.stats(),
+        "loop": loop_monitor.stats(),
+        "fsm": {"sessions": await storage.session_count()},
+    }
+    return PlainTextResponse(metrics.render(gauges), media_type="text/plain; version=0.0.4")
 
 @app.post("/webhook")
 async def telegram_webhook(request: Request):
-    data = await request.json()
-    update = Update.model_validate(data)  # ← преобразуем dict → Update
-    await dp.feed_update(bot, update)
+    # Spoofed requests are rejected before the body is even read
+    secret = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+    # Compared as bytes: compare_digest rejects non-ASCII str with TypeError
+    if WEBHOOK_SECRET and not hmac.compare_digest(secret.encode(), WEBHOOK_SECRET.encode()):
+        return JSONResponse(status_code=403, content={"ok": False})
+    # Shutting down: Telegram retries, and the next instance gets the update
+    if not accepting_updates:
+        return JSONResponse(status_code=503, content={"ok": False, "error": "shutting down"})
+
+    try:
+        data = json_loads(await request.body())
+    except ValueError:
+        return JSONResponse(status_code=400, content={"ok": False, "error": "invalid JSON"})
+    if not isinstance(data, dict):
+        return JSONResponse(status_code=400, content={"ok": False, "error": "invalid update"})
+    # Update kinds without handlers are acknowledged before pydantic validation
+    if not any(kind in data for kind in ALLOWED_UPDATES):
+        return {"ok": True}
+    if update_recorder is not None:
+        update_recorder.record(data)
+
+    # Validated before the claim: a body that fails here must not leave its id claimed
+    try:
+        update = Update.model_validate(data)  # ← преобразуем dict → Update
+    except ValidationError as e:
+        logger.warning(f"Rejected an invalid update: {e.error_count()} errors")
+        return JSONResponse(status_code=400, content={"ok": False, "error": "invalid update"})
+
+    # Redelivery of an update we already accepted - acknowledge without processing
+    if not await update_dedupe.claim(update.update_id):
+        return {"ok": True}
+
+    # Answer Telegram immediately, the update is processed by the queue workers
+    if not update_queue.put_nowait(update):
+        await update_dedupe.release(update.update_id)
+        return JSONResponse(status_code=503, content={"ok": False, "error": "queue is full"})
     return {"ok": True}
 
 @app.on_event("startup")
 async def on_startup():
-    webhook_url = f"https://{os.getenv('KOYEB_APP_URL')}/webhook"
-    await bot.set_webhook(webhook_url)
+    # Tables for history, subscriptions and broadcasts
+    try:
+        init_db()
+    except Exception as e:
+        logger.warning(f"⚠️ Failed to initialize the database: {e}")
+    stop_accepting_on_signal()
+    handed_over = load_warm_state() if SNAPSHOT_PATH else []
+    loop_monitor.start()
+    update_queue.start()
+    # Updates the previous instance accepted but did not get to
+    for data in handed_over:
+        update = Update.model_validate(data)
+        # A redelivery of it must not be processed a second time
+        await update_dedupe.adopt(update.update_id)
+        if handover_backlog or update_queue.depth() >= update_queue.maxsize:
+            handover_backlog.append(update)
+        else:
+            update_queue.put_nowait(update)
+    if handover_backlog:
+        logger.warning(f"⚠️ {len(handover_backlog)} handed-over updates wait for room in the queue")
+        background_tasks.append(asyncio.create_task(feed_handover_backlog()))
+    # Nothing below is needed to serve the first update: the app starts listening right away
+    background_tasks.append(asyncio.create_task(background_startup()))
+
+def stop_accepting_on_signal():
+    """
+    Refusing webhooks from the moment the stop signal arrives
+
+    uvicorn runs the shutdown event only after it has stopped listening and waited
+    for open connections, and requests on those keep arriving meanwhile. Its own
+    SIGTERM/SIGINT handlers (installed before startup) are wrapped so the flag is
+    cleared first; only the main thread can install signal handlers.
+    """
+    if threading.current_thread() is not threading.main_thread():
+        return
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        previous = signal.getsignal(sig)
+        if not callable(previous):
+            continue
+
+        def handler(signum, frame, previous=previous):
+            global accepting_updates
+            accepting_updates = False
+            previous(signum, frame)
+
+        signal.signal(sig, handler)
+
+async def feed_handover_backlog():
+    """Moving the handover backlog into the queue whenever it has room (webhook updates wait behind it)"""
+    while handover_backlog:
+        if update_queue.depth() >= update_queue.maxsize:
+            await asyncio.sleep(0.1)
+            continue
+        update_queue.put_nowait(handover_backlog.popleft())
+
+def load_warm_state() -> List[Dict]:
+    """Picking up caches and dialogs previous workers left behind, returns their unprocessed updates"""
+    updates = []
+    for path in claim_snapshots(SNAPSHOT_PATH):
+        started = time.perf_counter()
+        payload = read_snapshot(path, SNAPSHOT_VERSION)
+        if payload is not None:
+            sections = payload['sections']
+            updates += sections.get('updates', [])
+            try:
+                restored = restore_warm_state(sections, max(0.0, time.time() - payload['created_at']))
+                restored['updates'] = len(sections.get('updates', []))
+                logger.info(f"♻️ Warm start from {path} in {(time.perf_counter() - started) * 1000:.0f} ms: {restored}")
+            except Exception as e:
+                logger.error(f"Failed to restore the snapshot: {e}")
+        # A crash later must not bring back dialogs that have finished since
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+    return updates
+
+async def save_warm_state(updates: List[Update]):
+    """Writing caches, dialogs and not yet processed updates for the next instance"""
+    started = time.perf_counter()
+    path = worker_snapshot_path(SNAPSHOT_PATH)
+    try:
+        sections = dump_warm_state()
+        sections['updates'] = [update.model_dump(mode='json', by_alias=True, exclude_unset=True) for update in updates]
+        size = await asyncio.get_running_loop().run_in_executor(
+            None, write_snapshot, path, sections, SNAPSHOT_VERSION)
+        counts = {name: len(entries) for name, entries in sections.items()}
+        logger.info(f"💾 Snapshot {path} written in {(time.perf_counter() - started) * 1000:.0f} ms "
+                    f"({size} bytes): {counts}")
+    except Exception as e:
+        logger.error(f"Failed to write the snapshot: {e}")
+
+def webhook_url() -> str:
+    # getWebhookInfo does not return the secret, so a fingerprint of the settings is part of the URL
+    fingerprint = hashlib.sha256(f"{WEBHOOK_SECRET}|{','.join(sorted(ALLOWED_UPDATES))}".encode()).hexdigest()[:12]
+    return f"https://{os.getenv('KOYEB_APP_URL')}/webhook?v={fingerprint}"
+
+async def ensure_webhook():
+    """Registering the webhook only when the URL or settings changed since the last boot"""
+    url = webhook_url()
+    try:
+        info = await bot.get_webhook_info()
+        if info.url == url and set(info.allowed_updates or []) == set(ALLOWED_UPDATES):
+            logger.info("Webhook is already up to date")
+            return
+    except Exception as e:
+        logger.warning(f"⚠️ getWebhookInfo failed: {e}")
+    await bot.set_webhook(url, secret_token=WEBHOOK_SECRET, allowed_updates=ALLOWED_UPDATES)
+    logger.info("✅ Webhook registered")
+
+async def background_startup():
+    """Warm-ups that run while the first updates are already being served"""
+    # Network-bound: concurrently, today's rates make the first quote skip the NBU round trip
+    results = await asyncio.gather(ensure_webhook(), get_nbu_rates(datetime.now()), return_exceptions=True)
+    for result in results:
+        if isinstance(result, Exception):
+            logger.error(f"Startup warm-up failed: {result}")
+
+    # CPU-heavy chart rendering and broadcasts wait until the cold start is over
+    await asyncio.sleep(STARTUP_WARMUP_DELAY)
+    background_tasks.append(asyncio.create_task(chart_warmup_loop()))
+    background_tasks.append(asyncio.create_task(broadcast_loop()))
+
+@app.on_event("shutdown")
+async def on_shutdown():
+    """
+    Orderly shutdown: nothing that Telegram was told is accepted gets lost
+
+    Webhooks are refused from the stop signal on (or from here, when the app
+    is stopped without one), accepted updates get up to
+    SHUTDOWN_DRAIN_TIMEOUT seconds to finish, and those that were never started
+    go to the warm-start snapshot for the next instance. Only then are the
+    sessions, pools and databases closed.
+    """
+    global accepting_updates
+    accepting_updates = False
+    timings: Dict[str, int] = {}
+    started = last = time.perf_counter()
+
+    def lap(phase: str):
+        nonlocal last
+        now = time.perf_counter()
+        timings[phase] = round((now - last) * 1000)
+        last = now
+
+    # Broadcasts are resumable (leased in SQLite), chart warm-up starts over next time
+    for task in background_tasks:
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    await loop_monitor.stop()
+    lap('background')
+
+    depth = update_queue.depth()
+    if not await update_queue.drain(SHUTDOWN_DRAIN_TIMEOUT):
+        stats = update_queue.stats()
+        logger.warning(f"⚠️ Drain deadline of {SHUTDOWN_DRAIN_TIMEOUT:.0f} s reached: "
+                       f"{stats['depth']} updates queued, {stats['active_users']} in progress")
+    # The handover backlog is older than anything queued: it goes first
+    leftover = list(handover_backlog) + await update_queue.stop()
+    handover_backlog.clear()
+    lap('drain')
+
+    if SNAPSHOT_PATH:
+        await save_warm_state(leftover)
+    elif leftover:
+        logger.warning(f"⚠️ {len(leftover)} updates dropped: set SNAPSHOT_PATH to hand them over")
+    lap('snapshot')
+
+    # Handlers are done: outbound sessions and worker processes can go
+    shutdown_chart_pool()
+    await close_http_session()
+    await bot.session.close()
+    lap('sessions')
+
+    await storage.close()
+    update_dedupe.close()
+    # Buffered recorded updates are written out
+    if update_recorder is not None:
+        update_recorder.close()
+    lap('storage')
+
+    logger.info(f"👋 Shutdown in {(time.perf_counter() - started) * 1000:.0f} ms "
+                f"(queued at start: {depth}, handed over: {len(leftover)}): {timings}")
 
 
 
@@ -41,5 +358,3 @@ async def on_startup():
 # @app.on_event("startup")
 # async def on_startup():
 #     asyncio.create_task(dp.start_polling(bot))
-
-
@@ -0,0 +1,98 @@
+import sys
+import tracemalloc
+from typing import Any, List, Optional, Set, Tuple
+
+# Allocation sites of the profiler itself and of the import machinery are noise
+_SNAPSHOT_FILTERS = (
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+    tracemalloc.Filter(False, '<frozen importlib._bootstrap_external>'),
+    tracemalloc.Filter(False, '<unknown>'),
+)
+
+
+def deep_size(value: Any, _seen: Optional[Set[int]] = None) -> int:
+    """Approximate deep size in bytes: containers, object attributes, shared objects counted once"""
+    if _seen is None:
+        _seen = set()
+    if id(value) in _seen:
+        return 0
+    _seen.add(id(value))
+
+    size = sys.getsizeof(value)
+    if isinstance(value, (str, bytes, bytearray, int, float, bool, type(None))):
+        return size
+    if isinstance(value, dict):
+        size += sum(deep_size(k, _seen) + deep_size(v, _seen) for k, v in value.items())
+    elif isinstance(value, (list, tuple, set, frozenset)):
+        size += sum(deep_size(item, _seen) for item in value)
+    elif hasattr(value, '__dict__'):
+        size += deep_size(vars(value), _seen)
+    return size
+
+
+def rss_bytes() -> Optional[int]:
+    """Resident memory of the process (Linux), None elsewhere"""
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def format_bytes(size: float) -> str:
+    for unit in ('B', 'KB', 'MB'):
+        if abs(size) < 1024:
+            return f"{size:.0f} {unit}"
+        size /= 1024
+    return f"{size:.1f} GB"
+
+
+class AllocationTracker:
+    """
+    tracemalloc top allocation sites and the growth since the previous report
+
+    Tracing costs memory and CPU on every allocation, so it is started on demand
+    (or for the whole run with PYTHONTRACEMALLOC=<frames>).
+    """
+
+    def __init__(self, frames: int = 10):
+        self.frames = frames
+        self._previous: Optional[tracemalloc.Snapshot] = None
+
+    @property
+    def tracing(self) -> bool:
+        return tracemalloc.is_tracing()
+
+    def start(self):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(self.frames)
+        self._previous = None
+
+    def stop(self):
+        tracemalloc.stop()
+        self._previous = None
+
+    def report(self, limit: int = 10) -> Tuple[List[str], List[str]]:
+        """Top allocation sites by size and the largest changes since the previous report"""
+        snapshot = tracemalloc.take_snapshot().filter_traces(_SNAPSHOT_FILTERS)
+        top = [self._format_stat(stat.traceback, stat.size, stat.count)
+               for stat in snapshot.statistics('lineno')[:limit]]
+
+        diff = []
+        if self._previous is not None:
+            for stat in snapshot.compare_to(self._previous, 'lineno')[:limit]:
+                if stat.size_diff:
+                    diff.append(self._format_stat(stat.traceback, stat.size_diff, stat.count_diff, signed=True))
+        self._previous = snapshot
+        return top, diff
+
+    @staticmethod
+    def _format_stat(trace: tracemalloc.Traceback, size: int, count: int, signed: bool = False) -> str:
+        frame = trace[0]
+        filename = frame.filename.rsplit('/', 1)[-1]
+        sign = '+' if signed and size > 0 else ''
+        return f"{sign}{format_bytes(size)} ({sign}{count}) {filename}:{frame.lineno}"
@@ -0,0 +1,161 @@
+import time
+from abc import ABC, abstractmethod
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Any, Awaitable, Callable, Dict, List, Mapping, Tuple
+
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject, Update
+
+# Latency buckets, seconds (NBU and Bot API calls are 50 ms - several seconds)
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_registry: List["Metric"] = []
+
+
+def _format_labels(names: Tuple[str, ...], values: Tuple[str, ...], extra: str = '') -> str:
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Metric(ABC):
+    """
+    Base of the in-process metrics
+
+    Updates are plain dict/list operations on the event loop thread: no locks and
+    no allocation after the first sample of a label set, cheap enough to stay on.
+    """
+
+    kind = 'untyped'
+
+    def __init__(self, name: str, documentation: str, labels: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        _registry.append(self)
+
+    @abstractmethod
+    def samples(self) -> List[str]:
+        """Sample lines of the text exposition format"""
+
+    def render(self) -> List[str]:
+        return [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}'] + self.samples()
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def __init__(self, name: str, documentation: str, labels: Tuple[str, ...] = ()):
+        super().__init__(name, documentation, labels)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, *label_values: str, amount: float = 1):
+        self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def samples(self) -> List[str]:
+        return [f'{self.name}{_format_labels(self.labels, key)} {value:g}' for key, value in self._values.items()]
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labels: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = buckets
+        # label values -> [per-bucket counts (+Inf last), sum]
+        self._values: Dict[Tuple[str, ...], list] = {}
+
+    def observe(self, value: float, *label_values: str):
+        entry = self._values.get(label_values)
+        if entry is None:
+            entry = self._values[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+        entry[0][bisect_left(self.buckets, value)] += 1
+        entry[1] += value
+
+    @contextmanager
+    def time(self, *label_values: str):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, *label_values)
+
+    def samples(self) -> List[str]:
+        lines = []
+        for key, (counts, total) in self._values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                le = 'le="+Inf"' if bound == float('inf') else f'le="{bound:g}"'
+                lines.append(f'{self.name}_bucket{_format_labels(self.labels, key, le)} {cumulative}')
+            lines.append(f'{self.name}_sum{_format_labels(self.labels, key)} {total:.6f}')
+            lines.append(f'{self.name}_count{_format_labels(self.labels, key)} {cumulative}')
+        return lines
+
+
+def render(gauges: Mapping[str, Mapping[str, float]] = None) -> str:
+    """
+    Prometheus text format of all metrics
+
+    `gauges` are point-in-time values read at scrape time (queue depths etc.):
+    {'update_queue': {'depth': 3, ...}} becomes bot_update_queue_depth 3.
+    """
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    for group, values in (gauges or {}).items():
+        for key, value in values.items():
+            if not isinstance(value, (int, float)):
+                continue
+            name = f'bot_{group}_{key}'
+            lines.append(f'# TYPE {name} gauge')
+            lines.append(f'{name} {value:g}')
+    return '\n'.join(lines) + '\n'
+
+
+updates_total = Counter('bot_updates_total', 'Updates passed to the dispatcher by type', ('type',))
+handler_seconds = Histogram('bot_handler_seconds', 'Handler latency', ('handler',))
+handler_errors_total = Counter('bot_handler_errors_total', 'Handlers that raised', ('handler',))
+nbu_request_seconds = Histogram('bot_nbu_request_seconds', 'NBU API request latency', ('endpoint',))
+nbu_errors_total = Counter('bot_nbu_errors_total', 'Failed or empty NBU API requests', ('endpoint',))
+db_seconds = Histogram('bot_db_seconds', 'SQLite access time (connect, queries, close)', ('query',))
+cache_requests_total = Counter('bot_cache_requests_total', 'Cache lookups', ('cache', 'result'))
+loop_lag_seconds = Histogram('bot_loop_lag_seconds', 'Event loop scheduling delay of the heartbeat')
+loop_stalls_total = Counter('bot_loop_stalls_total', 'Event loop stalls caught by the watchdog thread')
+
+
+class UpdateMetricsMiddleware(BaseMiddleware):
+    """Outer middleware of dp.update: counts updates by type"""
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: Update,
+        data: Dict[str, Any]
+    ) -> Any:
+        updates_total.inc(event.event_type)
+        return await handler(event, data)
+
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    """Inner middleware: latency and errors per handler function"""
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any]
+    ) -> Any:
+        handler_object = data.get('handler')
+        name = handler_object.callback.__name__ if handler_object is not None else 'unknown'
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            handler_errors_total.inc(name)
+            raise
+        finally:
+            handler_seconds.observe(time.perf_counter() - started, name)
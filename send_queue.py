@@ -0,0 +1,173 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, List
+
+from aiogram import Bot
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import Response, TelegramMethod
+from aiogram.methods.base import TelegramType
+
+from tracing import span
+
+logger = logging.getLogger(__name__)
+
+# Priority of sends made from the current task: interactive replies or bulk (broadcasts)
+send_priority: ContextVar[str] = ContextVar('send_priority', default='interactive')
+
+
+@contextmanager
+def bulk_sends():
+    """Marking sends inside the block as low-priority bulk traffic"""
+    token = send_priority.set('bulk')
+    try:
+        yield
+    finally:
+        send_priority.reset(token)
+
+
+def refill(bucket: List[float], now: float, rate: float, burst: float):
+    """Token bucket [tokens, updated_at]: add tokens for the elapsed time"""
+    bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * rate)
+    bucket[1] = now
+
+
+class SendScheduler(BaseRequestMiddleware):
+    """
+    Outbound pacing of Bot API calls that post to a chat
+
+    Sends wait (instead of failing) for a global token bucket (~30 msg/s) and a
+    per-chat bucket (~1 msg/s in private chats, 20 msg/min in groups). Bulk sends
+    leave `bulk_reserve` global tokens to interactive replies and yield to any
+    waiting interactive send. RetryAfter (429) is retried automatically.
+    """
+
+    def __init__(self, global_rate: float = 30, global_burst: float = 30, chat_rate: float = 1.0,
+                 chat_burst: float = 3, group_rate: float = 20 / 60, bulk_reserve: float = 5,
+                 max_retries: int = 3, chat_idle_ttl: float = 600):
+        self.global_rate = global_rate
+        self.global_burst = global_burst
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.group_rate = group_rate
+        self.bulk_reserve = bulk_reserve
+        self.max_retries = max_retries
+        self.chat_idle_ttl = chat_idle_ttl
+
+        self._global = [global_burst, time.monotonic()]
+        # chat_id -> [tokens, updated_at], ordered by last send
+        self._chats: "OrderedDict[int, List[float]]" = OrderedDict()
+        self._interactive_waiting = 0
+
+        # Statistics
+        self.waiting = 0
+        self.sent = 0
+        self.delayed = 0
+        self.retried = 0
+
+    def _chat_bucket(self, chat_id: int, now: float) -> List[float]:
+        while self._chats:
+            oldest_id, oldest = next(iter(self._chats.items()))
+            if now - oldest[1] <= self.chat_idle_ttl:
+                break
+            self._chats.popitem(last=False)
+
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            bucket = self._chats[chat_id] = [self.chat_burst, now]
+        self._chats.move_to_end(chat_id)
+        return bucket
+
+    async def _acquire(self, chat_id: int, bulk: bool):
+        """Waiting for both the global and the chat token"""
+        chat_rate = self.chat_rate if chat_id > 0 else self.group_rate
+        reserve = self.bulk_reserve if bulk else 0
+        first_try = True
+        # Interactive send waiting for a global token: bulk sends step aside
+        blocking_bulk = False
+        try:
+            while True:
+                now = time.monotonic()
+                refill(self._global, now, self.global_rate, self.global_burst)
+                chat = self._chat_bucket(chat_id, now)
+                refill(chat, now, chat_rate, self.chat_burst)
+
+                yield_to_interactive = bulk and self._interactive_waiting > 0
+                if not yield_to_interactive and self._global[0] >= 1 + reserve and chat[0] >= 1:
+                    self._global[0] -= 1
+                    chat[0] -= 1
+                    return
+
+                if first_try:
+                    self.delayed += 1
+                    first_try = False
+                if not bulk and not blocking_bulk and self._global[0] < 1:
+                    blocking_bulk = True
+                    self._interactive_waiting += 1
+                wait = max(
+                    (1 + reserve - self._global[0]) / self.global_rate,
+                    (1 - chat[0]) / chat_rate,
+                    0.01
+                )
+                await asyncio.sleep(wait)
+        finally:
+            if blocking_bulk:
+                self._interactive_waiting -= 1
+
+    async def __call__(
+        self,
+        make_request: NextRequestMiddlewareType[TelegramType],
+        bot: Bot,
+        method: TelegramMethod[TelegramType],
+    ) -> Response[TelegramType]:
+        chat_id = getattr(method, 'chat_id', None)
+        if not isinstance(chat_id, int):
+            # Callback/inline answers, getMe, webhook calls etc. are not rate limited per chat
+            with span(f"send:{method.__api_method__}"):
+                return await make_request(bot, method)
+
+        bulk = send_priority.get() == 'bulk'
+        for attempt in range(self.max_retries + 1):
+            self.waiting += 1
+            try:
+                with span("send:wait"):
+                    await self._acquire(chat_id, bulk)
+            finally:
+                self.waiting -= 1
+
+            try:
+                with span(f"send:{method.__api_method__}"):
+                    response = await make_request(bot, method)
+                self.sent += 1
+                return response
+            except TelegramRetryAfter as e:
+                if attempt == self.max_retries:
+                    raise
+                self.retried += 1
+                logger.warning(f"429 для чату {chat_id}, повтор через {e.retry_after} с")
+                # The chat bucket goes negative: this retry and every other send to the
+                # chat wait in _acquire until the flood wait is over
+                chat_rate = self.chat_rate if chat_id > 0 else self.group_rate
+                chat = self._chat_bucket(chat_id, time.monotonic())
+                chat[0] = 1 - e.retry_after * chat_rate
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            'waiting': self.waiting,
+            'sent': self.sent,
+            'delayed': self.delayed,
+            'retried': self.retried,
+            'chats': len(self),
+        }
+
+    def __len__(self) -> int:
+        """Chats with a live bucket"""
+        return len(self._chats)
+
+    def buckets(self) -> Dict[int, List[float]]:
+        """Copy of the per-chat buckets (for memory reports)"""
+        return dict(self._chats)
@@ -0,0 +1,110 @@
+import gzip
+import json
+import logging
+import os
+import re
+import tempfile
+import time
+from typing import Any, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# Layout of the file itself; the caller versions the contents of the sections
+FORMAT = 'automoto-snapshot'
+FORMAT_VERSION = 1
+
+
+def write_snapshot(path: str, sections: Dict[str, Any], version: int) -> int:
+    """
+    Writing a gzip-compressed JSON snapshot atomically, returns its size in bytes
+
+    The data goes to a temporary file in the same directory, which is fsynced and
+    then renamed over `path`, so a crash midway leaves the previous snapshot intact.
+    """
+    payload = {
+        'format': FORMAT,
+        'format_version': FORMAT_VERSION,
+        'version': version,
+        'created_at': time.time(),
+        'sections': sections,
+    }
+    data = gzip.compress(json.dumps(payload, ensure_ascii=False, separators=(',', ':')).encode(), compresslevel=6)
+
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(prefix='.snapshot-', dir=directory)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+    return len(data)
+
+
+def worker_snapshot_path(path: str) -> str:
+    """File this process writes its snapshot to: workers never overwrite each other"""
+    return f"{path}.{os.getpid()}"
+
+
+def claim_snapshots(path: str) -> List[str]:
+    """
+    Taking over the snapshots previous workers left at `path`, returns the claimed files (oldest first)
+
+    Every worker writes `<path>.<pid>` (a plain `path` is picked up as well). A file is
+    claimed by renaming it to a name only this process uses, so when several workers
+    start at once each snapshot, and the updates handed over in it, is loaded exactly once.
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    pattern = re.compile(re.escape(os.path.basename(path)) + r'(\.\d+)?')
+    try:
+        names = [name for name in os.listdir(directory) if pattern.fullmatch(name)]
+    except OSError:
+        return []
+
+    candidates = []
+    for name in names:
+        candidate = os.path.join(directory, name)
+        try:
+            candidates.append((os.path.getmtime(candidate), candidate))
+        except OSError:
+            continue
+
+    claimed = []
+    for _, candidate in sorted(candidates):
+        target = f"{candidate}.claimed-{os.getpid()}"
+        try:
+            os.rename(candidate, target)
+        except OSError:
+            # Another worker was faster
+            continue
+        claimed.append(target)
+    return claimed
+
+
+def read_snapshot(path: str, version: int) -> Optional[Dict[str, Any]]:
+    """
+    Snapshot payload ('created_at', 'sections'), or None if there is none usable
+
+    Missing, unreadable and foreign files as well as other versions are skipped:
+    a cold start is always a safe fallback.
+    """
+    try:
+        with open(path, 'rb') as f:
+            payload = json.loads(gzip.decompress(f.read()))
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        logger.warning(f"⚠️ Знімок {path} пошкоджено: {e}")
+        return None
+
+    if not isinstance(payload, dict) or payload.get('format') != FORMAT \
+            or payload.get('format_version') != FORMAT_VERSION:
+        logger.warning(f"⚠️ {path} не є знімком стану")
+        return None
+    if payload.get('version') != version:
+        logger.info(f"Знімок {path} має версію {payload.get('version')}, очікується {version}: пропущено")
+        return None
+    return payload
@@ -0,0 +1,113 @@
+import logging
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from aiogram import BaseMiddleware
+from aiogram.types import CallbackQuery, Message, TelegramObject
+
+logger = logging.getLogger(__name__)
+
+
+def refill(bucket: List[float], now: float, rate: float, burst: float) -> bool:
+    """Token bucket [tokens, updated_at]: refill by elapsed time; True if a token is available"""
+    bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * rate)
+    bucket[1] = now
+    return bucket[0] >= 1
+
+
+class ThrottlingMiddleware(BaseMiddleware):
+    """
+    Per-user and global token buckets for incoming messages and button presses
+
+    A user over the limit gets one notice, further updates are dropped until the
+    bucket refills (dropped button presses are still answered, without text, so
+    their spinner stops). A token is only spent when both buckets have one.
+    Buckets of users idle for `idle_ttl` seconds are evicted, so memory is O(1)
+    per active user.
+    """
+
+    def __init__(self, rate: float = 1.0, burst: float = 5, global_rate: float = 50, global_burst: float = 100,
+                 idle_ttl: float = 600, notice: str = "⏳ Забагато запитів. Зачекайте кілька секунд."):
+        self.rate = rate
+        self.burst = burst
+        self.global_rate = global_rate
+        self.global_burst = global_burst
+        self.idle_ttl = idle_ttl
+        self.notice = notice
+
+        # user_id -> [tokens, updated_at, notified], ordered by last activity
+        self._users: "OrderedDict[int, List[float]]" = OrderedDict()
+        self._global = [global_burst, time.monotonic()]
+
+        # Statistics
+        self.throttled_user = 0
+        self.throttled_global = 0
+
+    def _evict_idle(self, now: float):
+        while self._users:
+            user_id, bucket = next(iter(self._users.items()))
+            if now - bucket[1] <= self.idle_ttl:
+                break
+            self._users.popitem(last=False)
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any]
+    ) -> Any:
+        user = data.get('event_from_user')
+        if user is None:
+            return await handler(event, data)
+
+        now = time.monotonic()
+        self._evict_idle(now)
+
+        bucket = self._users.get(user.id)
+        if bucket is None:
+            bucket = self._users[user.id] = [self.burst, now, 0]
+        else:
+            self._users.move_to_end(user.id)
+
+        # Both buckets are checked before either is charged
+        if not refill(bucket, now, self.rate, self.burst):
+            self.throttled_user += 1
+            first = not bucket[2]
+            bucket[2] = 1
+            await self._reject(event, self.notice if first else None)
+            return None
+
+        if not refill(self._global, now, self.global_rate, self.global_burst):
+            self.throttled_global += 1
+            logger.warning(f"Глобальний ліміт запитів перевищено, оновлення від {user.id} відкинуто")
+            await self._reject(event, None)
+            return None
+
+        bucket[0] -= 1
+        self._global[0] -= 1
+        bucket[2] = 0
+        return await handler(event, data)
+
+    async def _reject(self, event: TelegramObject, text: Optional[str]):
+        """Answering a dropped update: callbacks always (spinner), messages only with a notice"""
+        try:
+            if isinstance(event, CallbackQuery) or (text and isinstance(event, Message)):
+                await event.answer(text)
+        except Exception as e:
+            logger.error(f"Помилка повідомлення про ліміт: {e}")
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            'active_users': len(self),
+            'throttled_user': self.throttled_user,
+            'throttled_global': self.throttled_global,
+        }
+
+    def __len__(self) -> int:
+        """Users with a live bucket"""
+        return len(self._users)
+
+    def buckets(self) -> Dict[int, List[float]]:
+        """Copy of the per-user buckets (for memory reports)"""
+        return dict(self._users)
@@ -0,0 +1,139 @@
+import logging
+import os
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject, Update
+
+logger = logging.getLogger(__name__)
+
+
+class Trace:
+    """Span tree of one update: [name, start, duration, depth] relative to the update start"""
+
+    def __init__(self, update: Update):
+        self.update_id = update.update_id
+        self.event_type = update.event_type
+        self.started = time.perf_counter()
+        self.spans: List[list] = []
+
+    def format(self, total: float) -> str:
+        lines = [f"оновлення {self.update_id} ({self.event_type}): {total * 1000:.0f} мс"]
+        for name, start, duration, depth in self.spans:
+            duration = f"{duration * 1000:.0f} мс" if duration is not None else "не завершено"
+            lines.append(f"{'  ' * (depth + 1)}{name}: {duration} (+{start * 1000:.0f} мс)")
+        return '\n'.join(lines)
+
+
+current_trace: ContextVar[Optional[Trace]] = ContextVar('current_trace', default=None)
+_span_depth: ContextVar[int] = ContextVar('span_depth', default=0)
+
+
+@contextmanager
+def span(name: str):
+    """
+    Timing a block inside the current update's trace (no-op outside an update)
+
+    Tasks started by the handler (asyncio.gather) copy the context, so their spans
+    land in the same trace.
+    """
+    trace = current_trace.get()
+    if trace is None:
+        yield
+        return
+
+    depth = _span_depth.get()
+    token = _span_depth.set(depth + 1)
+    entry = [name, time.perf_counter() - trace.started, None, depth]
+    trace.spans.append(entry)
+    try:
+        yield
+    finally:
+        entry[2] = time.perf_counter() - trace.started - entry[1]
+        _span_depth.reset(token)
+
+
+class TracingMiddleware(BaseMiddleware):
+    """
+    Outer middleware of dp.update: a span tree per update
+
+    Updates slower than `slow_threshold` seconds are logged with their breakdown.
+    With `profile_every` > 0 every N-th update also runs under cProfile and the
+    stats are written to `profile_dir` (open with `python -m pstats` or snakeviz).
+    The profiler sees the whole thread, so concurrent updates show up too.
+    """
+
+    def __init__(self, slow_threshold: float = 2.0, profile_every: int = 0, profile_dir: str = 'profiles'):
+        self.slow_threshold = slow_threshold
+        self.profile_every = profile_every
+        self.profile_dir = profile_dir
+        self._seen = 0
+        self._profiling = False
+
+        # Statistics
+        self.slow = 0
+        self.profiled = 0
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: Update,
+        data: Dict[str, Any]
+    ) -> Any:
+        trace = Trace(event)
+        token = current_trace.set(trace)
+
+        self._seen += 1
+        profiler = None
+        # Only one profiler can be active per thread
+        if self.profile_every and self._seen % self.profile_every == 0 and not self._profiling:
+            import cProfile
+            profiler = cProfile.Profile()
+            self._profiling = True
+            profiler.enable()
+
+        try:
+            return await handler(event, data)
+        finally:
+            total = time.perf_counter() - trace.started
+            current_trace.reset(token)
+            if profiler is not None:
+                profiler.disable()
+                self._profiling = False
+                self._dump_profile(profiler, trace)
+            if total >= self.slow_threshold:
+                self.slow += 1
+                logger.warning(f"🐢 Повільне {trace.format(total)}")
+
+    def _dump_profile(self, profiler, trace: Trace):
+        try:
+            os.makedirs(self.profile_dir, exist_ok=True)
+            path = os.path.join(self.profile_dir, f"update-{trace.update_id}-{trace.event_type}.prof")
+            profiler.dump_stats(path)
+            self.profiled += 1
+        except Exception as e:
+            logger.error(f"Помилка збереження профілю: {e}")
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            'slow': self.slow,
+            'profiled': self.profiled,
+        }
+
+
+class HandlerSpanMiddleware(BaseMiddleware):
+    """Inner middleware: the handler function as a span of the update"""
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any]
+    ) -> Any:
+        handler_object = data.get('handler')
+        name = handler_object.callback.__name__ if handler_object is not None else 'unknown'
+        with span(f"handler:{name}"):
+            return await handler(event, data)
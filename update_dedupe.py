@@ -0,0 +1,116 @@
+import asyncio
+import logging
+import sqlite3
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class UpdateDeduplicator:
+    """
+    Window of recently accepted update_id values
+
+    Telegram redelivers an update when the webhook was slow or failed, so an update_id
+    that was already accepted is acknowledged without processing it again. The window
+    is an in-memory ring of the last `size` ids; with `db_path` it is mirrored to SQLite
+    so that several workers share it. SQLite is only touched in a dedicated thread, so
+    a lock held by another worker never blocks the event loop.
+    """
+
+    def __init__(self, size: int = 10000, db_path: Optional[str] = None, retention: int = 86400):
+        self.size = size
+        self.retention = retention
+        # Accepted ids, oldest first
+        self._window: "OrderedDict[int, None]" = OrderedDict()
+
+        self._conn = None
+        self._executor = None
+        self._last_prune = time.time()
+        if db_path:
+            self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='update-dedupe')
+            self._conn = sqlite3.connect(db_path, isolation_level=None, check_same_thread=False)
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('PRAGMA busy_timeout=5000')
+            self._conn.execute('''
+                               CREATE TABLE IF NOT EXISTS processed_updates
+                               (
+                                   update_id INTEGER PRIMARY KEY,
+                                   seen_at   REAL NOT NULL
+                               )
+                               ''')
+
+        # Statistics
+        self.accepted = 0
+        self.suppressed = 0
+
+    def _remember(self, update_id: int):
+        self._window[update_id] = None
+        if len(self._window) > self.size:
+            self._window.popitem(last=False)
+
+    def _insert(self, update_id: int) -> bool:
+        """Claiming the id in the shared database (runs in the dedupe thread)"""
+        now = time.time()
+        inserted = self._conn.execute(
+            'INSERT OR IGNORE INTO processed_updates (update_id, seen_at) VALUES (?, ?)', (update_id, now)
+        ).rowcount
+        self._prune(now)
+        return bool(inserted)
+
+    def _delete(self, update_id: int):
+        self._conn.execute('DELETE FROM processed_updates WHERE update_id = ?', (update_id,))
+
+    async def claim(self, update_id: int) -> bool:
+        """True if the update is new (and is now marked as accepted), False for a redelivery"""
+        if update_id in self._window:
+            self.suppressed += 1
+            return False
+
+        if self._conn is not None:
+            inserted = await asyncio.get_running_loop().run_in_executor(self._executor, self._insert, update_id)
+            if not inserted:
+                # Already accepted by another worker
+                self._remember(update_id)
+                self.suppressed += 1
+                return False
+
+        self._remember(update_id)
+        self.accepted += 1
+        return True
+
+    async def adopt(self, update_id: int):
+        """Marking an update accepted by the previous instance (handed over on shutdown) as seen"""
+        if self._conn is not None:
+            # Usually the previous instance's row is still there, the insert is then a no-op
+            await asyncio.get_running_loop().run_in_executor(self._executor, self._insert, update_id)
+        self._remember(update_id)
+        self.accepted += 1
+
+    async def release(self, update_id: int):
+        """Forgetting an update that was claimed but not accepted (so a redelivery is processed)"""
+        self._window.pop(update_id, None)
+        if self._conn is not None:
+            await asyncio.get_running_loop().run_in_executor(self._executor, self._delete, update_id)
+        self.accepted -= 1
+
+    def _prune(self, now: float):
+        """Telegram keeps undelivered updates for 24 hours, older ids are not needed"""
+        if now - self._last_prune < 300:
+            return
+        self._last_prune = now
+        self._conn.execute('DELETE FROM processed_updates WHERE seen_at < ?', (now - self.retention,))
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            'window': len(self._window),
+            'accepted': self.accepted,
+            'suppressed': self.suppressed,
+        }
+
+    def close(self):
+        if self._conn is not None:
+            self._executor.submit(self._conn.close)
+            self._executor.shutdown()
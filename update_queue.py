@@ -0,0 +1,205 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict, deque
+from typing import Awaitable, Callable, Deque, Dict, List, Optional, Set, Tuple
+
+from aiogram.types import Update
+from aiogram.types.update import UpdateTypeLookupError
+
+logger = logging.getLogger(__name__)
+
+
+def update_user_id(update: Update) -> Optional[int]:
+    """Telegram user who sent the update (None for updates without a user or of an unknown kind)"""
+    try:
+        event = update.event
+    except UpdateTypeLookupError:
+        return None
+    user = getattr(event, 'from_user', None)
+    return user.id if user else None
+
+
+class UpdateQueue:
+    """
+    Bounded queue of incoming updates processed by a pool of worker tasks
+
+    The webhook only enqueues and returns, so Telegram's request is never held open
+    while handlers talk to the NBU, SQLite or the Bot API. When the queue is full the
+    update is refused (the webhook answers 503 and Telegram redelivers it later).
+
+    Updates of different users run in parallel, while updates of one user are handled
+    strictly in arrival order (cost before currency, etc.). Repeated presses of the same
+    inline button within `duplicate_window` seconds are not handled; `on_duplicate` is
+    called for them right away (to answer the callback, so its spinner stops).
+    """
+
+    def __init__(self, handler: Callable[[Update], Awaitable], maxsize: int = 1000, workers: int = 8,
+                 duplicate_window: float = 2.0, on_duplicate: Optional[Callable[[Update], Awaitable]] = None):
+        self.handler = handler
+        self.on_duplicate = on_duplicate
+        self.workers = workers
+        self.maxsize = maxsize
+        self.duplicate_window = duplicate_window
+        self._queue: "asyncio.Queue[Tuple[float, Update]]" = asyncio.Queue()
+        self._tasks: List[asyncio.Task] = []
+        # Running on_duplicate calls (referenced until done)
+        self._duplicate_tasks: Set[asyncio.Task] = set()
+
+        # Per-user ordering: users being processed now and their waiting updates
+        self._active_users: Set[int] = set()
+        self._pending: Dict[int, Deque[Tuple[float, Update]]] = {}
+        self._pending_count = 0
+
+        # Recent callback presses: (user, message, data) -> monotonic time
+        self._recent_callbacks: "OrderedDict[Tuple[int, int, str], float]" = OrderedDict()
+
+        # Statistics
+        self.enqueued = 0
+        self.processed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.duplicates = 0
+        self.wait_last = 0.0
+        self.wait_max = 0.0
+        self._wait_total = 0.0
+
+    def _is_duplicate_callback(self, update: Update, now: float) -> bool:
+        """Same button of the same message pressed again within the window"""
+        while self._recent_callbacks:
+            key, pressed_at = next(iter(self._recent_callbacks.items()))
+            if now - pressed_at <= self.duplicate_window:
+                break
+            self._recent_callbacks.popitem(last=False)
+
+        callback = update.callback_query
+        if callback is None or callback.message is None:
+            return False
+        key = (callback.from_user.id, callback.message.message_id, callback.data or "")
+        if key in self._recent_callbacks:
+            return True
+        self._recent_callbacks[key] = now
+        return False
+
+    def put_nowait(self, update: Update) -> bool:
+        """Enqueue an update; False if the queue is full (load shedding)"""
+        if self.depth() >= self.maxsize:
+            self.rejected += 1
+            return False
+
+        now = time.monotonic()
+        if self._is_duplicate_callback(update, now):
+            # Accepted (Telegram gets 200) but never processed
+            self.duplicates += 1
+            if self.on_duplicate is not None:
+                task = asyncio.create_task(self._handle_duplicate(update))
+                self._duplicate_tasks.add(task)
+                task.add_done_callback(self._duplicate_tasks.discard)
+            return True
+
+        self._queue.put_nowait((now, update))
+        self.enqueued += 1
+        return True
+
+    async def _handle_duplicate(self, update: Update):
+        try:
+            await self.on_duplicate(update)
+        except Exception as e:
+            logger.warning(f"Помилка відповіді на повторне натискання {update.update_id}: {e}")
+
+    async def _process(self, enqueued_at: float, update: Update):
+        wait = time.monotonic() - enqueued_at
+        self.wait_last = wait
+        self.wait_max = max(self.wait_max, wait)
+        self._wait_total += wait
+        try:
+            await self.handler(update)
+            self.processed += 1
+        except Exception as e:
+            self.failed += 1
+            logger.exception(f"Помилка обробки оновлення {update.update_id}: {e}")
+        finally:
+            self._queue.task_done()
+
+    async def _worker(self):
+        while True:
+            enqueued_at, update = await self._queue.get()
+            user_id = update_user_id(update)
+            if user_id is None:
+                await self._process(enqueued_at, update)
+                continue
+
+            if user_id in self._active_users:
+                # Another worker is busy with this user: it will run the update next
+                self._pending.setdefault(user_id, deque()).append((enqueued_at, update))
+                self._pending_count += 1
+                continue
+
+            self._active_users.add(user_id)
+            try:
+                await self._process(enqueued_at, update)
+                pending = self._pending.get(user_id)
+                while pending:
+                    self._pending_count -= 1
+                    await self._process(*pending.popleft())
+            finally:
+                self._pending.pop(user_id, None)
+                self._active_users.discard(user_id)
+
+    def start(self):
+        """Starting worker tasks (inside the running event loop)"""
+        for _ in range(self.workers - len(self._tasks)):
+            self._tasks.append(asyncio.create_task(self._worker()))
+
+    async def drain(self, timeout: float) -> bool:
+        """Waiting until every accepted update is processed; False if `timeout` ran out first"""
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    async def stop(self) -> List[Update]:
+        """
+        Cancelling worker tasks, returns the updates that were never started
+
+        They are taken out before the workers are cancelled (per user, waiting updates
+        come before queued ones), so the caller can hand them over to the next instance.
+        Updates that were being handled at that moment are cut off.
+        """
+        leftover = [update for pending in self._pending.values() for _, update in pending]
+        while not self._queue.empty():
+            leftover.append(self._queue.get_nowait()[1])
+            self._queue.task_done()
+        if self._active_users:
+            logger.warning(f"⚠️ Обробку {len(self._active_users)} оновлень перервано")
+
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks.clear()
+        self._pending.clear()
+        self._pending_count = 0
+        return leftover
+
+    def depth(self) -> int:
+        """Updates waiting in the queue or behind another update of the same user"""
+        return self._queue.qsize() + self._pending_count
+
+    def stats(self) -> Dict[str, Optional[float]]:
+        """Queue depth, counters and waiting time (seconds)"""
+        waited = self.processed + self.failed
+        return {
+            'depth': self.depth(),
+            'maxsize': self.maxsize,
+            'active_users': len(self._active_users),
+            'workers': len(self._tasks),
+            'enqueued': self.enqueued,
+            'processed': self.processed,
+            'failed': self.failed,
+            'rejected': self.rejected,
+            'duplicates': self.duplicates,
+            'wait_last': round(self.wait_last, 4),
+            'wait_avg': round(self._wait_total / waited, 4) if waited else None,
+            'wait_max': round(self.wait_max, 4),
+        }
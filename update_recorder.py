@@ -0,0 +1,95 @@
+import hashlib
+import json
+import logging
+import os
+import time
+from typing import Any, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+# Objects that describe a person or a chat: ids are hashed, names dropped
+_IDENTITY_KEYS = {'from', 'chat', 'user', 'users', 'sender_chat', 'sender_user', 'forward_from',
+                  'forward_from_chat', 'via_bot', 'left_chat_member', 'new_chat_members'}
+_NAME_KEYS = {'first_name', 'last_name', 'username', 'title', 'bio', 'phone_number'}
+# Id fields of an identity object (shared users carry user_id) and ids outside one
+_ID_KEYS = {'id', 'user_id'}
+_LOOSE_ID_KEYS = {'user_chat_id'}
+# Plain-text names outside identity objects (hidden-user forwards, post signatures): some
+# are required fields, so they are replaced rather than dropped
+_SIGNATURE_KEYS = {'forward_sender_name', 'sender_user_name', 'author_signature', 'forward_signature'}
+# Personal data that is dropped as a whole: shared contacts and places
+_DROPPED_KEYS = {'contact', 'location', 'venue', 'live_location'}
+
+
+class UpdateRecorder:
+    """
+    Append-only log of incoming webhook updates for load testing
+
+    One compact JSON line per update: [received_at, update]. User and chat ids are
+    replaced by a salted hash (the same person keeps the same id, so per-user order
+    and dialogs survive); names, usernames, contacts and locations are removed. Lines
+    are buffered and flushed at most once per `flush_interval` seconds.
+    """
+
+    def __init__(self, path: str, salt: Optional[str] = None, flush_interval: float = 1.0):
+        self.path = path
+        # Without a fixed salt the hashes differ after a restart
+        self.salt = (salt or os.urandom(16).hex()).encode()
+        self.flush_interval = flush_interval
+        self._file = open(path, 'a', buffering=64 * 1024, encoding='utf-8')
+        self._last_flush = time.monotonic()
+
+        # Statistics
+        self.recorded = 0
+
+    def _digest(self, value: str) -> bytes:
+        return hashlib.blake2b(value.encode(), key=self.salt[:64], digest_size=6).digest()
+
+    def _hash_id(self, value: int) -> int:
+        hashed = int.from_bytes(self._digest(str(value)), 'big') % 10 ** 12 + 1
+        # Keep the sign: negative ids are groups and channels
+        return -hashed if value < 0 else hashed
+
+    def _anonymize(self, value: Any, identity: bool = False) -> Any:
+        if isinstance(value, dict):
+            result = {}
+            for key, item in value.items():
+                if identity and key in _NAME_KEYS:
+                    continue
+                if (identity and key in _ID_KEYS or key in _LOOSE_ID_KEYS) and isinstance(item, int):
+                    result[key] = self._hash_id(item)
+                elif key == 'chat_instance':
+                    result[key] = self._digest(str(item)).hex()
+                elif key in _DROPPED_KEYS:
+                    continue
+                elif key in _SIGNATURE_KEYS and isinstance(item, str):
+                    result[key] = 'User'
+                else:
+                    result[key] = self._anonymize(item, key in _IDENTITY_KEYS)
+            if identity and 'first_name' in value:
+                result['first_name'] = 'User'
+            return result
+        if isinstance(value, list):
+            # Items of an identity list (new_chat_members, users) are identities themselves
+            return [self._anonymize(item, identity) for item in value]
+        return value
+
+    def record(self, data: Dict):
+        """Writing one raw update (the dict Telegram posted)"""
+        try:
+            line = json.dumps([round(time.time(), 3), self._anonymize(data)], ensure_ascii=False,
+                              separators=(',', ':'))
+            self._file.write(line + '\n')
+            self.recorded += 1
+            now = time.monotonic()
+            if now - self._last_flush >= self.flush_interval:
+                self._file.flush()
+                self._last_flush = now
+        except Exception as e:
+            logger.error(f"Помилка запису оновлення: {e}")
+
+    def stats(self) -> Dict[str, int]:
+        return {'recorded': self.recorded}
+
+    def close(self):
+        self._file.close()